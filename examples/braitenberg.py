@@ -19,6 +19,7 @@ from pyafai import influence
 from pyafai import shapes
 from pyafai import objects
 import math
+import numpy
 import pyglet.window.key as key
 import pyglet.window.mouse as mouse
 import random
@@ -48,8 +49,14 @@ class Sensor(pyafai.Perception):
         super(Sensor, self).__init__(float, name)
         self._x = x
         self._y = y
+        # set by BraitenbergWorld when it has already read the sensor's value
+        # for this update, with all the others at once
+        self.read = False
 
     def update(self, agent):
+        if self.read:
+            self.read = False
+            return
         s = math.sin(agent.body.angle * DEG2RAD)
         c = math.cos(agent.body.angle * DEG2RAD)
         x = agent.body.x + c * self._x - s * self._y
@@ -159,8 +166,8 @@ class MyVehicle2(Vehicle):
 
 
 class BraitenbergWorld(pyafai.World2D):
-    def __init__(self, width=500, height=500, sector=10):
-        super(BraitenbergWorld, self).__init__(width, height)
+    def __init__(self, width=500, height=500, sector=10, headless=False):
+        super(BraitenbergWorld, self).__init__(width, height, headless)
 
         self._imap = influence.InfluenceMap(width, height, sector)
         self._imap_display = influence.InfluenceMapDisplay(self._imap, color=('c3B', (200,200,0)))
@@ -184,6 +191,30 @@ class BraitenbergWorld(pyafai.World2D):
         if self.show_influence_map:
             self._imap_display.draw()
 
+    def process_agents(self, delta):
+        self._update_sensors()
+        super(BraitenbergWorld, self).process_agents(delta)
+
+    def _update_sensors(self):
+        """Read the light at the position of all the sensors of all the
+        vehicles with a single call to the influence map."""
+        sensors = [(a.body, p) for a in self._agents
+                   for p in a._perceptions.values() if isinstance(p, Sensor)]
+        if not sensors:
+            return
+
+        state = numpy.array([(b.x, b.y, b.angle, p._x, p._y)
+                             for b, p in sensors])
+        rad = state[:, 2] * DEG2RAD
+        c = numpy.cos(rad)
+        s = numpy.sin(rad)
+        xs = state[:, 0] + c * state[:, 3] - s * state[:, 4]
+        ys = state[:, 1] + s * state[:, 3] + c * state[:, 4]
+        values = self._imap.sample(xs, ys)
+        for (body, sensor), value in zip(sensors, values):
+            sensor.value = float(value)
+            sensor.read = True
+
     def get_light(self, x, y):
         return self._imap.get_value(x, y)
 
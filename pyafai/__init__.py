@@ -20,6 +20,7 @@ An agent framework for the Introduction to Artificial Intelligence course.
 """
 
 from __future__ import division
+import os
 from .__version__ import __version__
 
 __docformat__ = 'restructuredtext'
@@ -32,6 +33,11 @@ except ImportError:
     print("Please install the pyglet package!")
     exit(1)
 
+# When running headless simulations (e.g. on compute nodes without a display)
+# pyglet must not try to create its hidden shadow window on import
+if os.environ.get('PYAFAI_HEADLESS'):
+    pyglet.options['shadow_window'] = False
+
 # import sub-modules
 from .core import *
 from . import core
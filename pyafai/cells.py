@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014-2016 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""This module contains the storage used by the grid world to keep track of
+the objects in each cell."""
+
+from __future__ import division
+from array import array
+import numpy
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+
+class ListGrid(list):
+    """Keeps the objects of each cell in a Python list. The grid itself is a
+    list of lines, so the cell at (x, y) is grid[y][x]."""
+
+    def __init__(self, width, height):
+        list.__init__(self, [[[] for c in range(width)]
+                             for l in range(height)])
+        self.width = width
+        self.height = height
+        # id(obj) -> (x, y)
+        self._cells = {}
+
+    def __getstate__(self):
+        return {'width': self.width, 'height': self.height}
+
+    def __setstate__(self, state):
+        # the lines are restored before the state
+        self.__dict__.update(state)
+        self._cells = {}
+        for y, line in enumerate(self):
+            for x, cell in enumerate(line):
+                for obj in cell:
+                    self._cells[id(obj)] = (x, y)
+
+    def add(self, obj, x, y):
+        self[y][x].append(obj)
+        self._cells[id(obj)] = (x, y)
+
+    def remove(self, obj):
+        x, y = self._cells.pop(id(obj))
+        self[y][x].remove(obj)
+
+    def move(self, obj, x, y):
+        """Move an object to the cell (x, y), if it is not already there."""
+        old = self._cells[id(obj)]
+        if old != (x, y):
+            self[old[1]][old[0]].remove(obj)
+            self[y][x].append(obj)
+            self._cells[id(obj)] = (x, y)
+
+    def get(self, x, y):
+        return self[y][x]
+
+    def iter_cell(self, x, y):
+        return iter(self[y][x])
+
+    def is_empty(self, x, y):
+        return len(self[y][x]) == 0
+
+    def counts(self):
+        """Return a NumPy array, indexed by [line, column], with the number of
+        objects in each cell."""
+        return numpy.array([[len(cell) for cell in line] for line in self],
+                           dtype=numpy.intc)
+
+
+class ArrayGrid(object):
+    """Keeps the objects of each cell in linked lists stored in integer
+    arrays, avoiding the creation of a Python list per cell.
+
+    Each object gets a slot, kept in its _grid_slot attribute, so an object
+    can only be in one grid at a time. For each cell the grid keeps the slots of its
+    first and last objects, and for each slot the previous and next slots in
+    the same cell and the index of the cell (-1 for free slots). All the
+    operations on a cell are O(1), except listing its contents. Cells out of
+    the grid raise an IndexError, as in :class:`ListGrid`.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self._head = array('i', [-1]) * (width * height)
+        self._tail = array('i', [-1]) * (width * height)
+        self._next = array('i')
+        self._prev = array('i')
+        self._cell = array('i')
+        # slot -> obj
+        self._objects = []
+        self._free = []
+
+    def _index(self, x, y):
+        """Return the index of the cell (x, y) in the cell arrays."""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("cell (%d, %d) is out of the grid" % (x, y))
+        return y * self.width + x
+
+    def _link(self, slot, c):
+        tail = self._tail[c]
+        self._prev[slot] = tail
+        self._next[slot] = -1
+        if tail == -1:
+            self._head[c] = slot
+        else:
+            self._next[tail] = slot
+        self._tail[c] = slot
+        self._cell[slot] = c
+
+    def _unlink(self, slot):
+        c = self._cell[slot]
+        prev = self._prev[slot]
+        next = self._next[slot]
+        if prev == -1:
+            self._head[c] = next
+        else:
+            self._next[prev] = next
+        if next == -1:
+            self._tail[c] = prev
+        else:
+            self._prev[next] = prev
+
+    def add(self, obj, x, y):
+        if self._free:
+            slot = self._free.pop()
+            self._objects[slot] = obj
+        else:
+            slot = len(self._objects)
+            self._objects.append(obj)
+            self._next.append(-1)
+            self._prev.append(-1)
+            self._cell.append(-1)
+        obj._grid_slot = slot
+        self._link(slot, self._index(x, y))
+
+    def remove(self, obj):
+        slot = obj._grid_slot
+        obj._grid_slot = None
+        self._unlink(slot)
+        self._cell[slot] = -1
+        self._objects[slot] = None
+        self._free.append(slot)
+
+    def move(self, obj, x, y):
+        """Move an object to the cell (x, y), if it is not already there."""
+        slot = obj._grid_slot
+        c = self._index(x, y)
+        if self._cell[slot] != c:
+            self._unlink(slot)
+            self._link(slot, c)
+
+    def iter_cell(self, x, y):
+        slot = self._head[self._index(x, y)]
+        while slot != -1:
+            yield self._objects[slot]
+            slot = self._next[slot]
+
+    def get(self, x, y):
+        return list(self.iter_cell(x, y))
+
+    def is_empty(self, x, y):
+        return self._head[self._index(x, y)] == -1
+
+    def counts(self):
+        """Return a NumPy array, indexed by [line, column], with the number of
+        objects in each cell."""
+        cells = numpy.frombuffer(self._cell, dtype=numpy.intc)
+        counts = numpy.bincount(cells[cells >= 0],
+                                minlength=self.width * self.height)
+        return counts.astype(numpy.intc).reshape(self.height, self.width)
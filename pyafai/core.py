@@ -20,32 +20,145 @@ An agent framework for the Introduction to Artificial Intelligence course.
 """
 
 from __future__ import division
+import ctypes
+import io
+import multiprocessing
+import pickle
+import random
+import timeit
+import numpy
 import pyglet
 import pyglet.window.key as key
 from . import shapes
+from . import spatial
+from . import cells
+from . import profiling
 
 __docformat__ = 'restructuredtext'
 __author__ = 'Tiago Baptista'
 
 
+class _SlotList(list):
+    """A list that keeps the position of each of its items, so that checking
+    if an item is in the list and removing it take constant time. Items are
+    compared by identity, and removing an item moves the last item to its
+    place.
+
+    Only append, extend, remove and clear keep the positions up to date.
+    """
+
+    def __init__(self, items=()):
+        list.__init__(self, items)
+        # id(item) -> position
+        self._slots = dict((id(item), i) for i, item in enumerate(self))
+
+    def __reduce_ex__(self, protocol):
+        # the positions are kept by id, which changes when copied
+        return self.__class__, (list(self),)
+
+    def __contains__(self, item):
+        return id(item) in self._slots
+
+    def append(self, item):
+        self._slots[id(item)] = len(self)
+        list.append(self, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def index(self, item, *args):
+        try:
+            return self._slots[id(item)]
+        except KeyError:
+            raise ValueError("item is not in the list")
+
+    def remove(self, item):
+        slot = self.index(item)
+        del self._slots[id(item)]
+        last = list.pop(self)
+        if slot < len(self):
+            list.__setitem__(self, slot, last)
+            self._slots[id(last)] = slot
+
+    def clear(self):
+        del self[:]
+        self._slots.clear()
+
+
+def _slot_descriptors(cls):
+    """Return a dict with the descriptors of the __slots__ of a class and of
+    its bases."""
+    result = {}
+    for c in reversed(cls.__mro__):
+        for name in c.__dict__.get('__slots__', ()):
+            if name not in ('__dict__', '__weakref__'):
+                result[name] = c.__dict__[name]
+    return result
+
+
+def _get_attributes(obj):
+    """Return a dict with the attributes of an object, both the ones in its
+    __slots__ and the ones in its __dict__ (if any)."""
+    state = dict(getattr(obj, '__dict__', {}))
+    for name, descriptor in _slot_descriptors(type(obj)).items():
+        try:
+            state[name] = descriptor.__get__(obj)
+        except AttributeError:
+            # not set
+            pass
+    return state
+
+
+def _set_attributes(obj, state):
+    """Set the attributes of an object from a dict returned by
+    _get_attributes."""
+    slots = _slot_descriptors(type(obj))
+    for name, value in state.items():
+        descriptor = slots.get(name)
+        if descriptor is not None:
+            descriptor.__set__(obj, value)
+        else:
+            obj.__dict__[name] = value
+
+
 class Object(object):
-    """This class represents a generic object in the world"""
+    """This class represents a generic object in the world.
+
+    To save memory, the attributes of objects are kept in __slots__, and the
+    list of shapes is only created when the first shape is added. Subclasses
+    that do not define __slots__ can add attributes as usual.
+    """
+
+    __slots__ = ('x', 'y', '_angle', '_batch', '_shapes', '_is_body',
+                 '_agent', 'scale', '_grid_slot')
 
     def __init__(self, x=0, y=0, angle=0.0):
         self.x = x
         self.y = y
         self._angle = angle
-        self._batch = pyglet.graphics.Batch()
-        self._shapes = []
+        self._batch = None
+        self._shapes = ()
         self._is_body = False
         self._agent = None
         self.scale = 1.0
+        # the slot of the object in a compact World2DGrid
+        self._grid_slot = None
 
     def __repr__(self):
         return str(type(self).__name__) + "(" + ",".join((str(self.x),
                                                           str(self.y),
                                                           str(self.angle))) + ")"
 
+    def __getstate__(self):
+        # the batch holds OpenGL resources, it is created again when needed
+        state = _get_attributes(self)
+        state['_batch'] = None
+        return state
+
+    def __setstate__(self, state):
+        _set_attributes(self, state)
+
     @property
     def is_body(self):
         return self._is_body
@@ -64,15 +177,34 @@ class Object(object):
             self._agent = agent
 
     def add_shape(self, shape):
-        shape.add_to_batch(self._batch)
-        self._shapes.append(shape)
+        # The batch is only created when the object is first drawn, so shapes
+        # are only sent to OpenGL when there is a display
+        if self._batch is not None:
+            shape.add_to_batch(self._batch)
+        if self._shapes:
+            self._shapes.append(shape)
+        else:
+            self._shapes = [shape]
 
     def clear_shapes(self):
-        self._shapes.clear()
+        self._shapes = ()
+
+    def _create_batch(self):
+        self._batch = pyglet.graphics.Batch()
+        for shape in self._shapes:
+            shape.add_to_batch(self._batch)
 
     def draw(self):
+        self.draw_at(self.x, self.y)
+
+    def draw_at(self, x, y):
+        """Draw the object at the (x, y) position on the screen, instead of at
+        its own position (e.g. when the world coordinates are not pixels)."""
+        if self._batch is None:
+            self._create_batch()
+
         pyglet.gl.glPushMatrix()
-        pyglet.gl.glTranslatef(self.x, self.y, 0)
+        pyglet.gl.glTranslatef(x, y, 0)
         pyglet.gl.glRotatef(self.angle, 0, 0, 1)
         if self.scale != 1:
             pyglet.gl.glScalef(self.scale, self.scale, self.scale)
@@ -115,6 +247,9 @@ class Object(object):
 class Agent(object):
     """This Class represents an agent in the world"""
 
+    __slots__ = ('keep_body_on_death', '_body', '_actions', '_perceptions',
+                 'world', '_dead')
+
     def __init__(self):
         self.keep_body_on_death = False
         self._body = None
@@ -150,6 +285,13 @@ class Agent(object):
             for action in actions:
                 action.execute(self)
 
+    def reset(self, *args, **kwargs):
+        """Prepare a dead agent to be reused by :meth:`World.spawn`, with the
+        arguments given to spawn. Subclasses should override it (calling this
+        method) to restore the state of a new agent, e.g. the position of the
+        body. Only the agents of classes that override it are reused."""
+        self._dead = False
+
     def kill(self):
         if not self._dead:
             self._dead = True
@@ -167,6 +309,8 @@ class Agent(object):
 class Perception(object):
     """A generic perception class."""
 
+    __slots__ = ('value', 'type', 'name')
+
     def __init__(self, t=int, name="None"):
         self.value = t()
         self.type = t
@@ -185,6 +329,8 @@ class Perception(object):
 class Action(object):
     """A generic action class."""
 
+    __slots__ = ('name',)
+
     def __init__(self, name="None"):
         self.name = name
 
@@ -199,16 +345,61 @@ class Action(object):
 
 
 class World(object):
-    """The environment where to put our agents and objects"""
+    """The environment where to put our agents and objects.
 
-    def __init__(self):
-        self._batch = pyglet.graphics.Batch()
-        self._agents = []
+    A headless world is never scheduled on the pyglet clock and never creates
+    OpenGL resources, so it can run on machines without a display. It is
+    created unpaused and is advanced explicitly with :meth:`step` or
+    :meth:`run`. On such machines the PYAFAI_HEADLESS environment variable
+    must be set (to any non-empty value) before importing pyafai, or pyglet
+    fails to open a display on import.
+
+    Other worlds are updated by the pyglet clock, by default once per frame
+    with the time elapsed since the last frame. Use :meth:`set_schedule` to
+    change how many simulation steps are done for each rendered frame.
+
+    :param headless: If True, create a world to be simulated without a display.
+    """
+
+    def __init__(self, headless=False):
+        self._batch = None
+        self._agents = _SlotList()
         self._dead_agents = []
-        self._objects = []
+        self._objects = _SlotList()
         self._shapes = []
-        self.paused = True
-        pyglet.clock.schedule_once(self._start_schedule, 0.5)
+        self.headless = headless
+        self.paused = not headless
+        self._pool = None
+        self._buffer = None
+        self._workers = 0
+        # an optional renderer that draws all the objects at once
+        self.renderer = None
+        # scheduling (see set_schedule)
+        self._dt = None
+        self._steps_per_frame = 1
+        self._max_speed = False
+        self._frame_rate = 60
+        self._scheduled = False
+        self.behind = False
+        # the profiler, when profiling (see start_profiling)
+        self.profiler = None
+        # the maximum number of dead agents of each class kept to be reused
+        # by spawn
+        self.pool_size = 0
+        self._agent_pool = {}
+        if not headless:
+            pyglet.clock.schedule_once(self._start_schedule, 0.5)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_batch'] = None
+        state['_pool'] = None
+        state['_buffer'] = None
+        state['_workers'] = 0
+        state['renderer'] = None
+        state['profiler'] = None
+        state['_agent_pool'] = {}
+        return state
 
     def add_object(self, obj):
         if isinstance(obj, Object):
@@ -234,6 +425,34 @@ class World(object):
             print("Trying to add an agent to the world that is not of type \
             Agent!")
 
+    def spawn(self, cls, *args, **kwargs):
+        """Add a new agent of a class to the world. If there is a dead agent
+        of that class in the pool (see pool_size), it is reused, with its
+        body and perceptions, by calling its reset method with the given
+        arguments. Otherwise, a new agent is created with them.
+
+        :param cls: The class of the agent.
+        :return: The agent added to the world.
+        """
+        pool = self._agent_pool.get(cls)
+        if pool:
+            agent = pool.pop()
+            agent.reset(*args, **kwargs)
+        else:
+            agent = cls(*args, **kwargs)
+        self.add_agent(agent)
+        return agent
+
+    def _recycle(self, agent, body):
+        """Keep a dead agent and its body to be reused by spawn, if there is
+        room in the pool of its class."""
+        cls = type(agent)
+        if self.pool_size > 0 and cls.reset is not Agent.reset:
+            pool = self._agent_pool.setdefault(cls, [])
+            if len(pool) < self.pool_size:
+                agent.body = body
+                pool.append(agent)
+
     def _remove_agent(self, agent):
         if agent in self._agents:
             agent.world = None
@@ -244,28 +463,296 @@ class World(object):
     def pause_toggle(self):
         self.paused = not self.paused
 
+    def start_workers(self, processes=None):
+        """Start a pool of worker processes to update the perceptions and
+        run the _think method of the agents in parallel.
+
+        On each update, a copy of the world is written once to a buffer
+        shared with the workers. For each agent, the workers return the
+        values of its perceptions, the attributes changed by _think and the
+        actions it decided to execute. These are applied to the agent in the
+        main process, and the actions are executed in the order of the
+        agents. References to the world, its objects and agents, and the
+        perceptions and actions of the agents are sent back as references to
+        the originals, not copies.
+
+        Changes made by _think to anything other than the agent itself (e.g.
+        its body) are lost, so agents should act on the world only through
+        the returned actions. Agents that override the update method are
+        always updated in the main process.
+
+        :param processes: The number of worker processes to use. Defaults to
+                          the number of CPUs.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self._start_pool(processes, 1 << 20)
+
+    def _start_pool(self, processes, capacity):
+        """Start the worker processes, sharing a buffer of capacity bytes
+        for the snapshots of the world."""
+        if self._pool is not None:
+            self.stop_workers()
+        self._buffer = multiprocessing.RawArray('c', capacity)
+        self._pool = multiprocessing.Pool(processes, _init_worker,
+                                          (self._buffer,))
+        self._workers = processes
+
+    def stop_workers(self):
+        """Stop the worker processes. Agents are updated sequentially again."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._buffer = None
+            self._workers = 0
+
+    def set_schedule(self, dt=None, steps_per_frame=1, max_speed=False,
+                     frame_rate=60):
+        """Configure how the world is updated by the pyglet clock.
+
+        On each frame the world does steps_per_frame simulation steps, of dt
+        seconds each. In max speed mode, the world instead does as many steps
+        as it can in the time of a frame, so it runs as fast as possible while
+        still being drawn. If the steps of a frame take longer than the frame
+        itself, the behind attribute is set and the display skips drawing
+        some frames to catch up.
+
+        :param dt: The duration of each simulation step, in seconds. If None,
+                   the time elapsed since the last frame is used.
+        :param steps_per_frame: The number of simulation steps per frame (the
+                                minimum number of steps in max speed mode).
+        :param max_speed: If True, use all the time of each frame to simulate.
+        :param frame_rate: The number of frames per second.
+        """
+        self._dt = dt
+        self._steps_per_frame = max(1, int(steps_per_frame))
+        self._max_speed = max_speed
+        self._frame_rate = frame_rate
+        self.behind = False
+        if self._scheduled:
+            pyglet.clock.unschedule(self._tick)
+            self._scheduled = False
+            self._start_schedule(0)
+
+    def start_profiling(self, window=120, agent_classes=False):
+        """Start measuring the time spent in each phase of the updates of the
+        world (and of drawing it, when displayed).
+
+        The phases are 'perceptions', 'think' and 'actions' (for agents that
+        do not override :meth:`Agent.update`; 'think' includes the
+        perceptions of the agents updated in workers), 'agents' (the rest of
+        :meth:`process_agents`), 'physics' (the physics store of a
+        :class:`World2D`), 'objects' (the updates of the objects), 'bounds'
+        (keeping the objects inside the world and updating their position in
+        the spatial index or grid), 'dead agents' and 'draw'.
+
+        :param window: The number of updates used for the statistics.
+        :param agent_classes: If True, also measure the time spent updating
+                              the agents of each class.
+        :return: The :class:`pyafai.profiling.Profiler` with the results.
+        """
+        self.profiler = profiling.Profiler(window, agent_classes)
+        return self.profiler
+
+    def stop_profiling(self):
+        self.profiler = None
+
     def _start_schedule(self, delta):
-        pyglet.clock.schedule_interval(self.update, 1 / 60.0)
+        if not self._scheduled:
+            pyglet.clock.schedule_interval(self._tick, 1 / self._frame_rate)
+            self._scheduled = True
+
+    def _tick(self, delta):
+        """Called by the pyglet clock on each frame."""
+        if self.paused:
+            self.behind = False
+            return
+
+        dt = delta if self._dt is None else self._dt
+        budget = 1 / self._frame_rate
+        start = timeit.default_timer()
+        for i in range(self._steps_per_frame):
+            self.update(dt)
+        if self._max_speed:
+            while timeit.default_timer() - start < budget:
+                self.update(dt)
+            self.behind = False
+        else:
+            self.behind = timeit.default_timer() - start > budget
 
     def update(self, delta):
         if not self.paused:
+            if self.profiler is not None:
+                self.profiler.start()
+
             # process agents
             self.process_agents(delta)
+            self._profile('agents')
 
             # update all objects
-            for obj in self._objects:
-                obj.update(delta)
+            self.update_objects(delta)
+            self._profile('objects')
 
             # remove dead agents
             self._remove_dead_agents()
+            self._profile('dead agents')
+            if self.profiler is not None:
+                self.profiler.end_tick()
+
+    def update_objects(self, delta):
+        for obj in self._objects:
+            obj.update(delta)
+
+    def _update_objects(self, objects, delta):
+        """Update some objects, calling _place_object after each update. When
+        profiling, the time spent placing the objects is in its own phase."""
+        place = self._place_object
+        if self.profiler is None:
+            for obj in objects:
+                obj.update(delta)
+                place(obj)
+        else:
+            timer = timeit.default_timer
+            placing = 0.0
+            for obj in objects:
+                obj.update(delta)
+                start = timer()
+                place(obj)
+                placing += timer() - start
+            self.profiler.split('bounds', placing)
+
+    def _place_object(self, obj):
+        """Keep an object inside the world after its update (implemented by
+        the subclasses that use _update_objects)."""
+        pass
+
+    def _profile(self, phase):
+        """Record the time since the last phase of the update, when
+        profiling."""
+        if self.profiler is not None:
+            self.profiler.lap(phase)
+
+    def step(self, delta):
+        """Advance the simulation by one time step.
+
+        :param delta: The time step, in seconds.
+        """
+        self.update(delta)
+
+    def run(self, steps, dt=1 / 60.0):
+        """Advance the simulation by a number of fixed time steps, as fast as
+        possible. Mainly useful for headless worlds.
+
+        :param steps: The number of time steps to simulate.
+        :param dt: The duration of each time step, in seconds.
+        """
+        for i in range(steps):
+            self.step(dt)
 
     def process_agents(self, delta):
-        for a in self._agents:
+        update = self._get_agent_updater(delta)
+        for i, a in enumerate(self._agents):
             if not a.is_dead:
-                a.update(delta)
+                update(i, a)
             else:
                 self._dead_agents.append(a)
 
+    def _get_agent_updater(self, delta):
+        """Return a function that updates the agent with a given index, with
+        the results of the workers (when thinking in workers), measuring its
+        phases (when profiling), or directly."""
+        prof = self.profiler
+        if prof is not None:
+            def update(i, agent):
+                self._update_agent_profiled(agent, delta)
+        else:
+            def update(i, agent):
+                agent.update(delta)
+
+        if self._pool is None:
+            return update
+
+        start = timeit.default_timer()
+        results = self._think_in_workers(delta)
+        if prof is not None:
+            prof.split('think', timeit.default_timer() - start)
+
+        def apply(i, agent):
+            if i not in results:
+                update(i, agent)
+            elif prof is not None:
+                with prof.measure('actions'):
+                    self._apply_think_result(agent, results[i])
+            else:
+                self._apply_think_result(agent, results[i])
+        return apply
+
+    def _update_agent_profiled(self, agent, delta):
+        """Update an agent, measuring its perceptions, thinking and actions
+        separately (unless its class overrides update), and the time of its
+        class if profiling agent classes."""
+        prof = self.profiler
+        timer = timeit.default_timer
+        start = timer()
+        if type(agent).update is Agent.update:
+            agent._update_perceptions()
+            perceived = timer()
+            actions = agent._think(delta)
+            thought = timer()
+            if actions:
+                for action in actions:
+                    action.execute(agent)
+            end = timer()
+            prof.split('perceptions', perceived - start)
+            prof.split('think', thought - perceived)
+            prof.split('actions', end - thought)
+        else:
+            agent.update(delta)
+            end = timer()
+        if prof.agent_classes:
+            prof.record('agent:' + type(agent).__name__, end - start)
+
+    def _think_in_workers(self, delta):
+        """Update the perceptions and think for all the living agents in the
+        worker processes. Return a dictionary with the result for each agent
+        index."""
+        indices = [i for i, a in enumerate(self._agents)
+                   if not a.is_dead and type(a).update is Agent.update]
+        if not indices:
+            return {}
+
+        # the snapshot is sent to the workers once, in the shared buffer
+        snapshot = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+        if len(snapshot) > len(self._buffer):
+            self._start_pool(self._workers, 2 * len(snapshot))
+        ctypes.memmove(self._buffer, snapshot, len(snapshot))
+        agents = list(self._agents)
+        objects = list(self._objects)
+
+        size = -(-len(indices) // self._workers)
+        chunks = [indices[k:k + size] for k in range(0, len(indices), size)]
+        # each chunk gets its own seed, so that the results are reproducible
+        # and the workers do not share the same random sequence
+        tasks = [(len(snapshot), chunk, delta, random.getrandbits(32))
+                 for chunk in chunks]
+
+        results = {}
+        for chunk, data in zip(chunks, self._pool.map(_think_agents, tasks)):
+            unpickler = _SnapshotUnpickler(io.BytesIO(data), self, agents,
+                                           objects)
+            results.update(zip(chunk, unpickler.load()))
+
+        return results
+
+    def _apply_think_result(self, agent, result):
+        values, state, actions = result
+        for name, value in values.items():
+            agent._perceptions[name].value = value
+        _set_attributes(agent, state)
+        for action in actions:
+            action.execute(agent)
+
     def _remove_dead_agents(self):
         for a in self._dead_agents:
             self._remove_agent(a)
@@ -274,46 +761,164 @@ class World(object):
             body.agent = None
             if not a.keep_body_on_death:
                 self.remove_object(body)
+                self._recycle(a, body)
 
         self._dead_agents.clear()
 
+    def get_pixel_transform(self):
+        """Return the (scale, offset) that convert a position in the world to
+        a position on the screen (x * scale + offset)."""
+        return 1, 0
+
     def draw(self):
+        if self._batch is None:
+            self._batch = pyglet.graphics.Batch()
+            for shape in self._shapes:
+                shape.add_to_batch(self._batch)
         self._batch.draw()
 
     def draw_objects(self):
+        if self.renderer is not None:
+            self.renderer.draw()
+            return
+
         for obj in self._objects:
             obj.draw()
 
 
 class World2D(World):
-    """A 2D continuous and closed world"""
-
-    def __init__(self, width=500, height=500):
-        World.__init__(self)
+    """A 2D continuous and closed world.
+
+    The world can optionally keep a spatial index of its objects, to speed up
+    the neighbour queries (:meth:`query_radius`, :meth:`query_rect` and
+    :meth:`nearest`). The index is updated at the end of each update, so
+    during an update the queries use the positions the objects had at the
+    end of the previous one.
+
+    The world can also keep the state of its simple physics objects in a
+    :class:`pyafai.objects.PhysicsStore`, that moves all of them (and keeps
+    them inside the world) in a single vectorized step. Only the objects
+    that do not override their update method are kept in the store.
+
+    :param index_cell: If given, use a spatial index with cells of this size.
+    :param physics: If True, integrate simple physics objects in a store.
+    """
+
+    def __init__(self, width=500, height=500, headless=False,
+                 index_cell=None, physics=False):
+        World.__init__(self, headless)
         self.width = width
         self.height = height
+        if index_cell is not None:
+            self._index = spatial.SpatialHash(index_cell)
+        else:
+            self._index = None
+        if physics:
+            from .objects import PhysicsStore
+            self._physics = PhysicsStore()
+            # the objects that are not in the store, updated one by one
+            self._other_objects = _SlotList()
+        else:
+            self._physics = None
 
-    def update(self, delta):
-        if not self.paused:
-            # process agents
-            self.process_agents(delta)
+    def add_object(self, obj):
+        World.add_object(self, obj)
+        if isinstance(obj, Object):
+            if self._index is not None:
+                self._index.add(obj)
+            if self._physics is not None:
+                if self._physics.accepts(obj):
+                    self._physics.add(obj)
+                else:
+                    self._other_objects.append(obj)
 
-            # update all objects
-            for obj in self._objects:
-                obj.update(delta)
+    def remove_object(self, obj):
+        World.remove_object(self, obj)
+        if not obj.is_body:
+            if self._index is not None:
+                self._index.remove(obj)
+            if self._physics is not None:
+                if obj in self._physics:
+                    self._physics.remove(obj)
+                elif obj in self._other_objects:
+                    self._other_objects.remove(obj)
+
+    def update_objects(self, delta):
+        if self._physics is not None:
+            # move all the objects in the store
+            self._physics.step(delta, self.width, self.height)
+            if self._index is not None:
+                for obj in self._physics.changed_cells(self._index.cell):
+                    self._index.update(obj)
+            objects = self._other_objects
+            self._profile('physics')
+        else:
+            objects = self._objects
 
-                # check bounds
-                if obj.x > self.width:
-                    obj.x = self.width
-                if obj.y > self.height:
-                    obj.y = self.height
-                if obj.x < 0:
-                    obj.x = 0
-                if obj.y < 0:
-                    obj.y = 0
+        self._update_objects(objects, delta)
 
-            # remove dead agents
-            self._remove_dead_agents()
+    def _place_object(self, obj):
+        # check bounds
+        if obj.x > self.width:
+            obj.x = self.width
+        if obj.y > self.height:
+            obj.y = self.height
+        if obj.x < 0:
+            obj.x = 0
+        if obj.y < 0:
+            obj.y = 0
+
+        if self._index is not None:
+            self._index.update(obj)
+
+    def query_radius(self, x, y, r):
+        """Return a list of the objects at a distance of at most r from the
+        position (x, y).
+
+        :param x: The x position
+        :param y: The y position
+        :param r: The maximum distance
+        """
+        if self._index is not None:
+            return self._index.query_radius(x, y, r)
+
+        r2 = r * r
+        return [obj for obj in self._objects
+                if (obj.x - x) ** 2 + (obj.y - y) ** 2 <= r2]
+
+    def query_rect(self, x1, y1, x2, y2):
+        """Return a list of the objects inside the rectangle with the lower
+        left corner at (x1, y1) and the upper right corner at (x2, y2).
+        """
+        if self._index is not None:
+            return self._index.query_rect(x1, y1, x2, y2)
+
+        return [obj for obj in self._objects
+                if x1 <= obj.x <= x2 and y1 <= obj.y <= y2]
+
+    def nearest(self, x, y, r=None, exclude=None):
+        """Return the object nearest to the position (x, y), if any.
+
+        :param x: The x position
+        :param y: The y position
+        :param r: If given, only consider objects at a distance of at most r.
+        :param exclude: An object to ignore (e.g. the body of the agent doing
+                        the query).
+        """
+        if self._index is not None:
+            return self._index.nearest(x, y, r, exclude)
+
+        best = None
+        best_d2 = float('inf') if r is None else r * r
+        for obj in self._objects:
+            if obj is exclude:
+                continue
+            d2 = (obj.x - x) ** 2 + (obj.y - y) ** 2
+            if d2 < best_d2 or (best is None and d2 <= best_d2):
+                best = obj
+                best_d2 = d2
+
+        return best
 
     def get_object_at(self, x, y):
         """Return the first object found at the screen's (x, y) position,
@@ -331,15 +936,23 @@ class World2D(World):
 
 
 class World2DGrid(World):
-    """A 2D Grid world, closed, and optionally toroidal"""
+    """A 2D Grid world, closed, and optionally toroidal.
+
+    By default, the objects in each cell are kept in a Python list. For large
+    grids with many objects, the compact option keeps them in integer arrays
+    instead (see :class:`pyafai.cells.ArrayGrid`). In that case
+    :meth:`get_cell_contents` returns a new list and not the cell itself.
+
+    :param compact: If True, use the array based storage for the cells.
+    """
 
     moore = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1),
              (1, 1))
     von_neumann = ((-1, 0), (0, -1), (1, 0), (0, 1))
 
     def __init__(self, width=25, height=25, cell=20, tor=False,
-                 nhood=moore, grid=True):
-        World.__init__(self)
+                 nhood=moore, grid=True, headless=False, compact=False):
+        World.__init__(self, headless)
         self._width = width
         self._height = height
         self.width = width * cell
@@ -348,13 +961,18 @@ class World2DGrid(World):
         self._half_cell = cell / 2
         self._tor = tor
         self._nhood = nhood
-        self._grid = [[[] for c in range(width)] for l in range(height)]
+        # neighbour table, built when first needed for the current _nhood
+        self._nhood_table = None
+        self._nhood_rows = None
+        self._nhood_key = None
+        if compact:
+            self._grid = cells.ArrayGrid(width, height)
+        else:
+            self._grid = cells.ListGrid(width, height)
 
         # visual grid
         if grid:
-            shape = shapes.Grid(width * cell, height * cell, cell)
-            shape.add_to_batch(self._batch)
-            self._shapes.append(shape)
+            self._shapes.append(shapes.Grid(width * cell, height * cell, cell))
 
     def add_object(self, obj):
         # check bounds
@@ -374,71 +992,71 @@ class World2DGrid(World):
                 obj.y = round(obj.y) % self._height
 
         World.add_object(self, obj)
-        self._grid[round(obj.y)][round(obj.x)].append(obj)
+        self._grid.add(obj, round(obj.x), round(obj.y))
 
     def remove_object(self, obj):
         World.remove_object(self, obj)
         if not obj.is_body:
-            self._grid[round(obj.y)][round(obj.x)].remove(obj)
+            self._grid.remove(obj)
+
+    def _get_grid_cell(self, obj):
+        """Return the cell of an object, even if it is outside the grid."""
+        x = round(obj.x)
+        y = round(obj.y)
+        if self._tor:
+            return x % self._width, y % self._height
+        return (min(max(x, 0), self._width - 1),
+                min(max(y, 0), self._height - 1))
 
     def process_agents(self, delta):
-        for a in self._agents:
+        update = self._get_agent_updater(delta)
+        for i, a in enumerate(self._agents):
             if not a.is_dead:
-                # remove body from grid
-                self._grid[round(a.body.y)][round(a.body.x)].remove(a.body)
-
-                a.update(delta)
+                update(i, a)
 
-                # re-add to grid
-                self._grid[round(a.body.y)][round(a.body.x)].append(a.body)
+                # move the body in the grid, if it changed cell. The body
+                # is only kept inside the world when the objects are updated
+                x, y = self._get_grid_cell(a.body)
+                self._grid.move(a.body, x, y)
 
             if a.is_dead:
                 self._dead_agents.append(a)
 
-    def update(self, delta):
-        if not self.paused:
-            # process agents
-            self.process_agents(delta)
-
-            # update all objects
-            for obj in self._objects:
-
-                # remove from _grid
-                self._grid[round(obj.y)][round(obj.x)].remove(obj)
-
-                obj.update(delta)
+    def update_objects(self, delta):
+        self._update_objects(self._objects, delta)
 
-                # check bounds
-                if not self._tor:
-                    if obj.x > self._width - 1:
-                        obj.x = self._width - 1
-                    if obj.y > self._height - 1:
-                        obj.y = self._height - 1
-                    if obj.x < 0:
-                        obj.x = 0
-                    if obj.y < 0:
-                        obj.y = 0
-                else:
-                    if obj.x > self._width - 0.5 or obj.x < -0.5:
-                        obj.x = round(obj.x) % self._width
-                    if obj.y > self._height - 0.5 or obj.y < -0.5:
-                        obj.y = round(obj.y) % self._height
+    def _place_object(self, obj):
+        # check bounds
+        if not self._tor:
+            if obj.x > self._width - 1:
+                obj.x = self._width - 1
+            if obj.y > self._height - 1:
+                obj.y = self._height - 1
+            if obj.x < 0:
+                obj.x = 0
+            if obj.y < 0:
+                obj.y = 0
+        else:
+            if obj.x > self._width - 0.5 or obj.x < -0.5:
+                obj.x = round(obj.x) % self._width
+            if obj.y > self._height - 0.5 or obj.y < -0.5:
+                obj.y = round(obj.y) % self._height
 
-                # re-add to _grid
-                self._grid[round(obj.y)][round(obj.x)].append(obj)
+        # move in the grid, if it changed cell
+        self._grid.move(obj, round(obj.x), round(obj.y))
 
-            # remove dead agents
-            self._remove_dead_agents()
+    def get_pixel_transform(self):
+        return self.cell, self._half_cell
 
     def draw_objects(self):
+        if self.renderer is not None:
+            self.renderer.draw()
+            return
+
+        # objects are drawn at the center of their cell
         for obj in self._objects:
-            x = obj.x
-            y = obj.y
-            obj.x = x * self.cell + self._half_cell
-            obj.y = y * self.cell + self._half_cell
-            obj.draw()
-            obj.x = x
-            obj.y = y
+            obj.draw_at(obj.x * self.cell + self._half_cell,
+                        obj.y * self.cell + self._half_cell)
 
     @property
     def grid_width(self):
@@ -449,13 +1067,13 @@ class World2DGrid(World):
         return self._height
 
     def is_empty(self, x, y):
-        return len(self._grid[int(round(y))][int(round(x))]) == 0
+        return self._grid.is_empty(int(round(x)), int(round(y)))
 
     def has_object_type_at(self, x, y, objtype):
         if self._tor:
             x = round(x) % self._width
             y = round(y) % self._height
-        for obj in self._grid[y][x]:
+        for obj in self._grid.iter_cell(x, y):
             if isinstance(obj, objtype):
                 return True
 
@@ -465,7 +1083,49 @@ class World2DGrid(World):
         return x // self.cell, y // self.cell
 
     def get_cell_contents(self, x, y):
-        return self._grid[round(y)][round(x)]
+        return self._grid.get(round(x), round(y))
+
+    def get_neighbour_table(self):
+        """Returns a NumPy array with the neighbours of every cell, using the
+        neighbourhood defined in _nhood. Line y * grid_width + x has the
+        indexes (y1 * grid_width + x1) of the neighbour cells of the cell at
+        (x, y), or -1 for neighbours outside a non toroidal grid.
+
+        The table is only computed again if the neighbourhood changes.
+        """
+        if self._nhood_key is not self._nhood:
+            w = self._width
+            h = self._height
+            ys, xs = numpy.divmod(numpy.arange(w * h), w)
+            table = numpy.empty((w * h, len(self._nhood)), dtype=numpy.intp)
+            for i, (dx, dy) in enumerate(self._nhood):
+                x1 = xs + dx
+                y1 = ys + dy
+                if self._tor:
+                    table[:, i] = (y1 % h) * w + x1 % w
+                else:
+                    inside = (0 <= x1) & (x1 < w) & (0 <= y1) & (y1 < h)
+                    table[:, i] = numpy.where(inside, y1 * w + x1, -1)
+            self._nhood_table = table
+            # without the cells outside the grid, for the single cell queries
+            self._nhood_rows = [[c for c in row if c >= 0]
+                                for row in table.tolist()]
+            self._nhood_key = self._nhood
+
+        return self._nhood_table
+
+    def _get_neighbour_cells(self, x, y):
+        """Returns the indexes of the neighbour cells of the cell at (x, y),
+        or None if the cell is outside the grid."""
+        x = round(x)
+        y = round(y)
+        if self._tor:
+            x %= self._width
+            y %= self._height
+        elif not (0 <= x < self._width and 0 <= y < self._height):
+            return None
+        self.get_neighbour_table()
+        return self._nhood_rows[y * self._width + x]
 
     def get_neighbours(self, x, y):
         """Returns a list of all the objects that are neighbours of the cell
@@ -476,18 +1136,16 @@ class World2DGrid(World):
         :return: A list with the neighbour objects.
         """
         result = []
-        x = round(x)
-        y = round(y)
-        for dx, dy in self._nhood:
-            x1 = x + dx
-            y1 = y + dy
-            if not self._tor and 0 <= x1 < self._width and \
-                                    0 <= y1 < self._height:
-                result.extend(self._grid[y1][x1])
-            elif self._tor:
-                x1 %= self._width
-                y1 %= self._height
-                result.extend(self._grid[y1][x1])
+        neighbours = self._get_neighbour_cells(x, y)
+        if neighbours is None:
+            # a cell outside of a non toroidal grid
+            for x1, y1 in self.get_neighbourhood(x, y):
+                result.extend(self._grid.iter_cell(x1, y1))
+            return result
+
+        w = self._width
+        for c in neighbours:
+            result.extend(self._grid.iter_cell(c % w, c // w))
 
         return result
 
@@ -499,23 +1157,173 @@ class World2DGrid(World):
         :param y: The cell's y coordinate (line).
         :return: A list of tuples with (x, y) coordinates of the neighbor cells.
         """
+        neighbours = self._get_neighbour_cells(x, y)
+        if neighbours is not None:
+            w = self._width
+            return [(c % w, c // w) for c in neighbours]
 
+        # a cell outside of a non toroidal grid
         result = []
         x = round(x)
         y = round(y)
         for dx, dy in self._nhood:
             x1 = x + dx
             y1 = y + dy
-            if not self._tor and 0 <= x1 < self._width and \
-                                    0 <= y1 < self._height:
-                result.append((x1, y1))
-            elif self._tor:
-                x1 %= self._width
-                y1 %= self._height
+            if 0 <= x1 < self._width and 0 <= y1 < self._height:
                 result.append((x1, y1))
 
         return result
 
+    def get_occupancy(self, objtype=None):
+        """Returns a NumPy array, indexed by [line, column], with the number
+        of objects in each cell.
+
+        :param objtype: If given, only count the objects of this type.
+        """
+        if objtype is None:
+            return self._grid.counts()
+
+        cells = [self._get_grid_cell(obj) for obj in self._objects
+                 if isinstance(obj, objtype)]
+        counts = numpy.zeros((self._height, self._width), dtype=numpy.intc)
+        if cells:
+            xs, ys = zip(*cells)
+            numpy.add.at(counts, (list(ys), list(xs)), 1)
+        return counts
+
+    def count_neighbours(self, values=None):
+        """Returns a NumPy array with the sum, for every cell, of the values of
+        its neighbour cells. Uses the neighbourhood defined in _nhood.
+
+        For example, for the Game of Life rules, the number of live
+        neighbours of each cell is count_neighbours(get_occupancy() > 0).
+
+        :param values: An array indexed by [line, column]. Defaults to the
+                       number of objects in each cell.
+        """
+        if values is None:
+            values = self._grid.counts()
+        values = numpy.asarray(values)
+        if values.dtype == bool:
+            values = values.astype(numpy.intc)
+
+        h = self._height
+        w = self._width
+        result = numpy.zeros_like(values)
+        for dx, dy in self._nhood:
+            if self._tor:
+                result += numpy.roll(values, (-dy, -dx), axis=(0, 1))
+            elif abs(dx) < w and abs(dy) < h:
+                # the neighbour at (x + dx, y + dy) of the cells inside
+                result[max(0, -dy):h - max(0, dy),
+                       max(0, -dx):w - max(0, dx)] += \
+                    values[max(0, dy):h - max(0, -dy),
+                           max(0, dx):w - max(0, -dx)]
+
+        return result
+
+
+def _snapshot_ids(world):
+    """Return a dict with the persistent ids of the world, its objects and
+    agents, and the perceptions and actions of the agents, by id(obj)."""
+    ids = {id(world): ('world',)}
+    for i, obj in enumerate(world._objects):
+        ids[id(obj)] = ('object', i)
+    for i, agent in enumerate(world._agents):
+        ids[id(agent)] = ('agent', i)
+        for name, p in agent._perceptions.items():
+            ids[id(p)] = ('perception', i, name)
+        for name, a in agent._actions.items():
+            ids[id(a)] = ('action', i, name)
+    return ids
+
+
+class _SnapshotPickler(pickle.Pickler):
+    """Pickles references to the contents of a world snapshot by their
+    position in the world, so that they are restored as the originals."""
+
+    def __init__(self, file, ids):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.ids = ids
+
+    def persistent_id(self, obj):
+        return self.ids.get(id(obj))
+
+    @classmethod
+    def dumps(cls, obj, ids):
+        f = io.BytesIO()
+        cls(f, ids).dump(obj)
+        return f.getvalue()
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    """Restores the references pickled by _SnapshotPickler as the originals,
+    from the lists of agents and objects of the world when the snapshot was
+    taken."""
+
+    def __init__(self, file, world, agents, objects):
+        pickle.Unpickler.__init__(self, file)
+        self.world = world
+        self.agents = agents
+        self.objects = objects
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == 'world':
+            return self.world
+        elif kind == 'object':
+            return self.objects[pid[1]]
+        elif kind == 'agent':
+            return self.agents[pid[1]]
+        elif kind == 'perception':
+            return self.agents[pid[1]]._perceptions[pid[2]]
+        elif kind == 'action':
+            return self.agents[pid[1]]._actions[pid[2]]
+        raise pickle.UnpicklingError("Unknown persistent id: %r" % (pid,))
+
+
+# the buffer with the world snapshot, in the worker processes
+_worker_buffer = None
+
+
+def _init_worker(buffer):
+    global _worker_buffer
+    _worker_buffer = buffer
+
+
+def _think_agents(task):
+    """Run in a worker process to update the perceptions and think for some
+    of the agents of the world snapshot in the shared buffer. Returns the
+    perception values, changed attributes and actions of each agent, pickled
+    with references to the snapshot contents."""
+    size, indices, delta, seed = task
+    random.seed(seed)
+    numpy.random.seed(seed)
+    world = pickle.loads(ctypes.string_at(ctypes.addressof(_worker_buffer),
+                                          size))
+    ids = _snapshot_ids(world)
+
+    results = []
+    for i in indices:
+        agent = world._agents[i]
+        before = dict((k, _SnapshotPickler.dumps(v, ids))
+                      for k, v in _get_attributes(agent).items()
+                      if k not in ('world', '_body'))
+        agent._update_perceptions()
+        actions = agent._think(delta)
+
+        # only the attributes that were changed (or rebound) are sent back
+        changed = {}
+        for k, v in _get_attributes(agent).items():
+            if k not in ('world', '_body') and \
+                    _SnapshotPickler.dumps(v, ids) != before.get(k):
+                changed[k] = v
+        values = dict((name, p.value)
+                      for name, p in agent._perceptions.items())
+        results.append((values, changed, list(actions) if actions else []))
+
+    return _SnapshotPickler.dumps(results, ids)
+
 
 class Display(pyglet.window.Window):
     """Class used to display the world"""
@@ -551,6 +1359,16 @@ class Display(pyglet.window.Window):
 
         self.show_fps = False
         self.fps_display = pyglet.clock.ClockDisplay()
+        # the maximum number of consecutive frames not drawn when the world
+        # is behind schedule
+        self.max_frame_skip = 5
+        self._skipped = 0
+        self._skip_frame = False
+
+        # profiler report, when the world is being profiled
+        self.show_profile = False
+        self._profile_label = None
+        self._profile_frames = 0
 
         self.world = world
         if self.world.paused:
@@ -559,6 +1377,19 @@ class Display(pyglet.window.Window):
             self.set_caption(self.caption.replace(" (paused)", ""))
 
     def on_draw(self):
+        # skip this frame if the simulation is behind schedule
+        if getattr(self.world, 'behind', False) and \
+                self._skipped < self.max_frame_skip:
+            self._skipped += 1
+            self._skip_frame = True
+            return
+        self._skipped = 0
+        self._skip_frame = False
+
+        prof = getattr(self.world, 'profiler', None)
+        if prof is not None:
+            start = timeit.default_timer()
+
         # clear window
         self.clear()
 
@@ -568,15 +1399,39 @@ class Display(pyglet.window.Window):
         # draw objects
         self.world.draw_objects()
 
+        if prof is not None:
+            prof.record_frame('draw', timeit.default_timer() - start)
+
         # show fps
         if self.show_fps:
             self.fps_display.draw()
 
+        # show profiler report
+        if self.show_profile and prof is not None:
+            self._draw_profile(prof)
+
+    def _draw_profile(self, prof):
+        # the report is only updated a few times per second
+        if self._profile_label is None or self._profile_frames % 15 == 0:
+            self._profile_label = pyglet.text.Label(
+                prof.report(), font_name='Courier New', font_size=9,
+                x=10, y=self.height - 10, anchor_y='top', multiline=True,
+                width=self.width - 20, color=(255, 255, 255, 200))
+        self._profile_frames += 1
+        self._profile_label.draw()
+
+    def flip(self):
+        # keep showing the last frame drawn
+        if not self._skip_frame:
+            super(Display, self).flip()
+
     def on_key_press(self, symbol, modifiers):
         super(Display, self).on_key_press(symbol, modifiers)
 
         if symbol == key.F:
             self.show_fps = not (self.show_fps)
+        elif symbol == key.P:
+            self.show_profile = not self.show_profile
         elif symbol == key.SPACE:
             self.world.pause_toggle()
             if self.world.paused:
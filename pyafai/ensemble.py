@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014-2016 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""This module contains helpers to run many independent simulations of the
+same scenario (e.g. with different random seeds) in parallel, without a
+display."""
+
+from __future__ import division
+import multiprocessing
+import random
+import numpy
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+
+def default_metrics(world):
+    """The metrics collected by default: the number of agents and objects in
+    the world."""
+    return {'agents': len(world._agents), 'objects': len(world._objects)}
+
+
+def run_ensemble(factory, steps, seeds, dt=1 / 60.0, metrics=default_metrics,
+                 every=None, processes=None):
+    """Run one simulation for each seed in a pool of worker processes, and
+    yield the results as each run finishes.
+
+    Before calling the factory, the random and numpy.random generators of
+    the worker are seeded with the run's seed. The world is then advanced
+    with :meth:`pyafai.World.step`, so the results are the same as in an
+    interactive run with the same time steps.
+
+    The factory and metrics functions must be defined at the top level of a
+    module, so that they can be sent to the worker processes.
+
+    :param factory: A function that receives a seed and returns a new
+                    (preferably headless) world.
+    :param steps: The number of time steps to simulate in each run.
+    :param seeds: The seeds of the runs.
+    :param dt: The duration of each time step, in seconds.
+    :param metrics: A function that receives a world and returns the metrics
+                    to collect.
+    :param every: If given, collect the metrics every this many steps, instead
+                  of only at the end of the run.
+    :param processes: The number of worker processes. Defaults to the number
+                      of CPUs. If 0, the runs are done in this process.
+    :return: An iterator over (seed, result) tuples, in the order the runs
+             finish. The result is the value returned by metrics, or a list
+             of those values if every is given.
+    """
+    tasks = [(factory, steps, seed, dt, metrics, every) for seed in seeds]
+
+    if processes == 0:
+        for task in tasks:
+            yield _run_world(task)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_run_world, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _run_world(task):
+    """Run a single simulation of an ensemble."""
+    factory, steps, seed, dt, metrics, every = task
+    random.seed(seed)
+    numpy.random.seed(seed)
+
+    world = factory(seed)
+    world.paused = False
+
+    if every is None:
+        world.run(steps, dt)
+        return seed, metrics(world)
+
+    samples = []
+    for i in range(1, steps + 1):
+        world.step(dt)
+        if i % every == 0:
+            samples.append(metrics(world))
+
+    return seed, samples
@@ -19,28 +19,45 @@
 provide sensory fields (e.g. for light or sound)"""
 
 from __future__ import division
+from collections import OrderedDict
 
 __docformat__ = 'restructuredtext'
 __author__ = 'Tiago Baptista'
 
 
-from . import shapes
+import ctypes
 import math
+import numpy
 import pyglet
 
 
 class Influence(object):
     """The abstract base class for influences to place in the influence map"""
+
+    __slots__ = ()
     
     def update(self, delta):
         pass
     
     def get_value(self, x, y):
         return 0.0
+
+    def get_extent(self):
+        """Return the distance from the influence's position beyond which its
+        value is always 0, or None if the influence is unbounded."""
+        return None
     
     
 class CircularInfluence(Influence):
-    """A circular influence emitter to place in the influence map"""
+    """A circular influence emitter to place in the influence map.
+
+    The diffuse functions accept either single coordinates or NumPy arrays of
+    coordinates, so that the influence map can evaluate all of its sectors at
+    once. Custom diffuse functions should do the same.
+    """
+
+    __slots__ = ('x', 'y', 'strength', 'radius', 'r', 'diffuse', 'static',
+                 'limit', 'degrade', 'func')
     
     def __init__(self, x, y, strength = 1.0, radius = 100, degrade = 0.0,
                  limit = 0.001, static = True):
@@ -74,25 +91,36 @@ class CircularInfluence(Influence):
     def get_value(self, x, y):
         return self.func(self, x, y)
 
+    def get_extent(self):
+        if self.func is CircularInfluence.linear_diffuse:
+            return max(self.strength / self.diffuse, 0)
+        elif self.func is CircularInfluence.light_diffuse and self.limit > 0:
+            if self.strength < self.limit:
+                return 0
+            return self.r * (math.sqrt(self.strength / self.limit) - 1)
+
+        # unknown diffuse function
+        return None
+
     def linear_diffuse(self, x, y):
-        dist = math.sqrt((x - self.x)**2 + (y - self.y)**2)
-        return max(self.strength - (self.diffuse * dist), 0)
+        dist = numpy.hypot(x - self.x, y - self.y)
+        return numpy.maximum(self.strength - (self.diffuse * dist), 0)
 
     def light_diffuse(self, x, y):
-        dist = math.sqrt((x - self.x)**2 + (y - self.y)**2)
+        dist = numpy.hypot(x - self.x, y - self.y)
         att = 1 / ((dist/self.r + 1)**2)
         res = self.strength * att
-        if res < self.limit:
-            return 0
-        return res
+        return res * (res >= self.limit)
 
 
-class InfluenceMap(object):
-    """A 2D influence map.
-    
-    TODO: Verify that the total size is divisible by the sector size.
+class GridMap(object):
+    """The base class of maps that divide the world in square sectors, with
+    one value per sector kept in a NumPy array indexed by [line, column].
+
+    Maps can be drawn with :class:`InfluenceMapDisplay` or
+    :class:`InfluenceMapTextureDisplay`.
     """
-    
+
     def __init__(self, width, height, sector, maximum = 1.0):
         self.width = width
         self.height = height
@@ -101,102 +129,652 @@ class InfluenceMap(object):
         self.sector = sector
         self.maximum = maximum
         self.dirty = True
-        
-        self._imap = [self.map_width * [0.0] for i in range(self.map_height)]
-        self._ilist = []
-        
-    def place(self, influence, update=True):
-        if 0 <= influence.x <= self.width and 0 <= influence.y <= self.height:
-            self._ilist.append(influence)
-            if update:
-                self.update()
+        # the range of lines changed since the last draw, or None
+        self.changed_lines = (0, self.map_height)
+
+        self._imap = numpy.zeros((self.map_height, self.map_width))
+
+    def _mark_changed(self, y0, y1):
+        """Add the lines y0 to y1 to the lines changed since the last draw."""
+        self.dirty = True
+        if self.changed_lines is None:
+            self.changed_lines = (y0, y1)
         else:
-            print("Tying to place an influence outside the limits of the map")
+            self.changed_lines = (min(self.changed_lines[0], y0),
+                                  max(self.changed_lines[1], y1))
 
     def get_value(self, x, y):
         if 0 < x < self.width and 0 < y < self.height:
             x = int(x // self.sector)
             y = int(y // self.sector)
-            return self._imap[y][x]
+            return self._imap[y, x]
         else:
             return 0.0
 
     def get_grid_value(self, x, y):
-        return self._imap[y][x]
+        return self._imap[y, x]
+
+    def sample(self, xs, ys, method='nearest'):
+        """Return the values of the map at many points at once. Points
+        outside the map have the value 0, as in :meth:`get_value`. For maps
+        with many layers, the result has one column per layer.
+
+        :param xs: The x coordinates of the points (a sequence or array).
+        :param ys: The y coordinates of the points.
+        :param method: 'nearest' to use the value of the sector containing
+                       each point, or 'bilinear' to interpolate between the
+                       centers of the nearest 4 sectors.
+        :return: A NumPy array with the value at each point.
+        """
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        inside = (xs > 0) & (xs < self.width) & (ys > 0) & (ys < self.height)
+        last_x = self.map_width - 1
+        last_y = self.map_height - 1
+
+        if method == 'nearest':
+            c = numpy.clip(xs // self.sector, 0, last_x).astype(numpy.intp)
+            l = numpy.clip(ys // self.sector, 0, last_y).astype(numpy.intp)
+            values = self._imap[l, c]
+        elif method == 'bilinear':
+            # position relative to the sector centers
+            fx = numpy.clip(xs / self.sector - 0.5, 0, last_x)
+            fy = numpy.clip(ys / self.sector - 0.5, 0, last_y)
+            c0 = fx.astype(numpy.intp)
+            l0 = fy.astype(numpy.intp)
+            c1 = numpy.minimum(c0 + 1, last_x)
+            l1 = numpy.minimum(l0 + 1, last_y)
+            tx = self._per_point(fx - c0)
+            ty = self._per_point(fy - l0)
+            values = ((self._imap[l0, c0] * (1 - tx) +
+                       self._imap[l0, c1] * tx) * (1 - ty) +
+                      (self._imap[l1, c0] * (1 - tx) +
+                       self._imap[l1, c1] * tx) * ty)
+        else:
+            raise ValueError("Unknown sampling method: %s" % method)
+
+        return numpy.where(self._per_point(inside), values, 0.0)
+
+    def _per_point(self, a):
+        """Reshape an array with one value per point so that it broadcasts
+        with the values of the map at those points."""
+        return a.reshape(a.shape + (1,) * (self._imap.ndim - 2))
+
+
+class InfluenceMap(GridMap):
+    """A 2D influence map. The map values are kept in a NumPy array indexed
+    by [line, column].
+
+    Each influence is only evaluated at the box of sectors covered by its
+    extent (see :meth:`Influence.get_extent`). Its contribution is kept, so
+    that when an influence changes (e.g. it degrades or moves) only that box
+    is recomputed. Adding and subtracting contributions accumulates rounding
+    errors, so the sum is rebuilt from the kept contributions every
+    resync_interval changes, and whenever the map becomes empty.
+
+    With a stamp cache, the values of :class:`CircularInfluence` objects
+    using the linear or light diffuse functions are computed from kernels
+    (stamps) shared by all the influences with the same radius, limit and
+    function, so that placing or moving an influence only scales and adds
+    a stamp. Each stamp is computed for the influence centered at one of
+    stamp_phases x stamp_phases positions inside a sector, and influences are
+    moved to the nearest of these positions. An influence moves at most
+    sector * sqrt(2) / (2 * stamp_phases), so its values change by at most
+    that distance times its slope: diffuse for the linear function, and
+    2 * strength / r for the light function (e.g. 0.18 with strength 1,
+    radius 30, sector 5 and 4 phases). Sectors at the limit of a light
+    influence can also be cut off or kept.
+    
+    TODO: Verify that the total size is divisible by the sector size.
+
+    :param stamp_cache: The maximum number of stamps to keep (the least
+                        recently used are discarded). If 0, stamps are not
+                        used.
+    :param stamp_phases: The number of positions of the stamps along each
+                         axis of a sector.
+    """
+    
+    def __init__(self, width, height, sector, maximum = 1.0, stamp_cache = 0,
+                 stamp_phases = 4):
+        super(InfluenceMap, self).__init__(width, height, sector, maximum)
+        self._ilist = []
+        self.stamp_cache = stamp_cache
+        self.stamp_phases = stamp_phases
+        self.resync_interval = 1000
+        # the number of contributions subtracted since the last resync
+        self._changes = 0
+        # (func, r, diffuse, limit, size, phase x, phase y) -> stamp
+        self._stamps = OrderedDict()
+
+        # sum of all contributions, before applying the maximum
+        self._sum = numpy.zeros((self.map_height, self.map_width))
+        # id(influence) -> (box, values, x, y, strength)
+        self._contrib = {}
+
+        # coordinates of the center of each column and line of sectors
+        self._xs = numpy.arange(self.map_width) * sector + sector / 2
+        self._ys = (numpy.arange(self.map_height) * sector + sector / 2)[:,
+                                                                       None]
         
+    def place(self, influence, update=True):
+        if 0 <= influence.x <= self.width and 0 <= influence.y <= self.height:
+            self._ilist.append(influence)
+            if update:
+                # add this and any other influences placed without update
+                for i in self._ilist:
+                    if id(i) not in self._contrib:
+                        self._clamp(self._add(i))
+                self.dirty = True
+        else:
+            print("Tying to place an influence outside the limits of the map")
+
+    def remove(self, influence):
+        if influence in self._ilist:
+            self._ilist.remove(influence)
+            if id(influence) in self._contrib:
+                self._clamp(self._subtract(influence))
+                if not self._contrib:
+                    # the last contribution was removed, clear any residue
+                    self._resync()
+                else:
+                    self._check_drift()
+                self.dirty = True
+        else:
+            print("Trying to remove an influence that is not in the map")
+
     def update_influences(self, delta):
-        res = False
+        """Update all the influences, and recompute the sectors reached by
+        those that have changed their position or strength, or that report a
+        change by returning True from their update method."""
         for i in self._ilist:
-            res = res or i.update(delta)
-
-        self.dirty = res
+            changed = i.update(delta)
+            contrib = self._contrib.get(id(i))
+            if contrib is not None and (
+                    changed or contrib[2] != i.x or contrib[3] != i.y or
+                    contrib[4] != getattr(i, 'strength', None)):
+                self._refresh(i)
+                self.dirty = True
+        self._check_drift()
+
+    def _get_box(self, influence):
+        """Return the (line, column) limits (y0, y1, x0, x1) of the sectors
+        covered by the extent of an influence."""
+        extent = influence.get_extent()
+        if extent is None:
+            return 0, self.map_height, 0, self.map_width
+
+        s = self.sector
+        x0 = max(int(math.floor((influence.x - extent) / s - 0.5)), 0)
+        x1 = min(int(math.ceil((influence.x + extent) / s - 0.5)) + 1,
+                 self.map_width)
+        y0 = max(int(math.floor((influence.y - extent) / s - 0.5)), 0)
+        y1 = min(int(math.ceil((influence.y + extent) / s - 0.5)) + 1,
+                 self.map_height)
+        return y0, max(y0, y1), x0, max(x0, x1)
+
+    def _evaluate(self, influence, xs, ys):
+        """Return the values of an influence at the sector centers given by
+        the broadcastable coordinate arrays xs and ys."""
+        try:
+            values = influence.get_value(xs, ys)
+        except (TypeError, ValueError):
+            # the influence only works with scalar coordinates
+            values = numpy.vectorize(influence.get_value,
+                                     otypes=[float])(xs, ys)
+        return values
+
+    def _compute(self, influence):
+        """Return the box of sectors reached by an influence, and its values
+        in those sectors (or None if it does not reach any sector)."""
+        if self.stamp_cache > 0 and self._uses_stamp(influence):
+            return self._stamp(influence)
+
+        y0, y1, x0, x1 = box = self._get_box(influence)
+        if y0 < y1 and x0 < x1:
+            return box, self._evaluate(influence, self._xs[x0:x1],
+                                       self._ys[y0:y1])
+        return box, None
+
+    @staticmethod
+    def _uses_stamp(influence):
+        return (isinstance(influence, CircularInfluence) and
+                type(influence).get_value is CircularInfluence.get_value and
+                influence.func in (CircularInfluence.linear_diffuse,
+                                   CircularInfluence.light_diffuse) and
+                influence.get_extent() is not None)
+
+    def _get_stamp(self, influence, n, px, py):
+        """Return the stamp of an influence's kind with n sectors on each side
+        of the center, for the influence at the phase (px, py) of the center
+        sector, from the cache or newly computed."""
+        key = (influence.func, influence.r, influence.diffuse, influence.limit,
+               n, px, py)
+        stamp = self._stamps.pop(key, None)
+        if stamp is None:
+            # distances from the phase position to the sector centers
+            phases = self.stamp_phases
+            d = numpy.arange(-n, n + 1) + 0.5
+            dx = (d - (px + 0.5) / phases) * self.sector
+            dy = (d - (py + 0.5) / phases) * self.sector
+            dist = numpy.hypot(dx[None, :], dy[:, None])
+            if influence.func is CircularInfluence.linear_diffuse:
+                stamp = -influence.diffuse * dist
+            else:
+                stamp = 1 / ((dist / influence.r + 1) ** 2)
+            if len(self._stamps) >= self.stamp_cache:
+                self._stamps.popitem(last=False)
+        # the most recently used stamps are at the end
+        self._stamps[key] = stamp
+        return stamp
+
+    def _stamp(self, influence):
+        """Compute the values of an influence by scaling a stamp centered on
+        the phase position nearest to it."""
+        extent = influence.get_extent()
+        n = int(math.ceil(extent / self.sector))
+        cx = min(int(influence.x // self.sector), self.map_width - 1)
+        cy = min(int(influence.y // self.sector), self.map_height - 1)
+        phases = self.stamp_phases
+        px = min(max(int((influence.x / self.sector - cx) * phases), 0),
+                 phases - 1)
+        py = min(max(int((influence.y / self.sector - cy) * phases), 0),
+                 phases - 1)
+        x0 = max(cx - n, 0)
+        x1 = min(cx + n + 1, self.map_width)
+        y0 = max(cy - n, 0)
+        y1 = min(cy + n + 1, self.map_height)
+        box = (y0, y1, x0, x1)
+        if y0 >= y1 or x0 >= x1 or influence.strength <= 0:
+            return box, None
+
+        stamp = self._get_stamp(influence, n, px, py)[
+            y0 - cy + n:y1 - cy + n, x0 - cx + n:x1 - cx + n]
+        if influence.func is CircularInfluence.linear_diffuse:
+            values = numpy.maximum(stamp + influence.strength, 0)
+        else:
+            values = influence.strength * stamp
+            values *= values >= influence.limit
+        return box, values
+
+    def _add(self, influence):
+        """Add the contribution of an influence to the map sum, and return
+        the box of sectors that changed."""
+        box, values = self._compute(influence)
+        if values is not None:
+            y0, y1, x0, x1 = box
+            self._sum[y0:y1, x0:x1] += values
+        else:
+            # the influence does not reach any sector
+            values = 0.0
+        self._contrib[id(influence)] = (box, values, influence.x, influence.y,
+                                        getattr(influence, 'strength', None))
+        return box
+
+    def _subtract(self, influence):
+        """Remove the last contribution of an influence from the map sum, and
+        return the box of sectors that changed."""
+        box, values = self._contrib.pop(id(influence))[:2]
+        y0, y1, x0, x1 = box
+        self._sum[y0:y1, x0:x1] -= values
+        self._changes += 1
+        return box
+
+    def _check_drift(self):
+        """Rebuild the map sum if enough contributions were subtracted since
+        the last time."""
+        if self._changes >= self.resync_interval:
+            self._resync()
+
+    def _resync(self):
+        """Rebuild the map sum from the kept contributions, discarding the
+        rounding errors of adding and subtracting them."""
+        self._sum[:] = 0
+        for box, values in (c[:2] for c in self._contrib.values()):
+            y0, y1, x0, x1 = box
+            self._sum[y0:y1, x0:x1] += values
+        self._changes = 0
+        self._clamp((0, self.map_height, 0, self.map_width))
+
+    def _clamp(self, box):
+        """Recompute the map values of a box of sectors from the map sum."""
+        y0, y1, x0, x1 = box
+        numpy.minimum(self._sum[y0:y1, x0:x1], self.maximum,
+                      out=self._imap[y0:y1, x0:x1])
+        if y0 < y1:
+            self._mark_changed(y0, y1)
+
+    def _refresh(self, influence):
+        """Replace the last contribution of an influence with its current
+        one."""
+        old = self._subtract(influence)
+        new = self._add(influence)
+        self._clamp((min(old[0], new[0]), max(old[1], new[1]),
+                     min(old[2], new[2]), max(old[3], new[3])))
 
     def update(self):
-        for y in range(self.map_height):
-            for x in range(self.map_width):
-                a = 0
-                for i in self._ilist:
-                    a = a + i.get_value(x * self.sector + self.sector/2,
-                                        y*self.sector + self.sector/2)
-                if a > self.maximum:
-                    a = self.maximum
-                self._imap[y][x] = a
+        """Recompute the whole map from all the influences."""
+        self._sum[:] = 0
+        self._contrib.clear()
+        self._changes = 0
+        for i in self._ilist:
+            self._add(i)
+        self._clamp((0, self.map_height, 0, self.map_width))
 
         self.dirty = True
             
 
+class LayeredInfluenceMap(InfluenceMap):
+    """An influence map with many layers (e.g. light, sound and scent),
+    stored in a single NumPy array indexed by [line, column, layer].
+
+    Each influence is evaluated once per update, and its values are added to
+    all the layers at once, multiplied by the influence's weight in each
+    layer. :meth:`get_value` and :meth:`sample` return the values of all the
+    layers, and :meth:`layer` returns a view of a single layer that can be
+    used as an influence map (e.g. to display it).
+
+    :param layers: The names of the layers.
+    """
+
+    def __init__(self, width, height, sector, layers, maximum = 1.0,
+                 stamp_cache = 0, stamp_phases = 4):
+        super(LayeredInfluenceMap, self).__init__(width, height, sector,
+                                                  maximum, stamp_cache,
+                                                  stamp_phases)
+        self.layers = list(layers)
+        self._index = dict((name, i) for i, name in enumerate(self.layers))
+        shape = (self.map_height, self.map_width, len(self.layers))
+        self._imap = numpy.zeros(shape)
+        self._sum = numpy.zeros(shape)
+        # id(influence) -> weight of the influence in each layer
+        self._weights = {}
+        # name -> view of a single layer
+        self._views = {}
+
+    def __getstate__(self):
+        # the views would no longer share the values of the map when copied
+        state = self.__dict__.copy()
+        state['_views'] = {}
+        return state
+
+    def place(self, influence, update=True, weights=None):
+        """Place an influence in the map.
+
+        :param weights: The weight of the influence in each layer, as a
+                        sequence or as a dict of layer names to weights
+                        (missing layers have weight 0). If None, the
+                        influence has weight 1 in all layers.
+        """
+        if weights is None:
+            w = numpy.ones(len(self.layers))
+        elif isinstance(weights, dict):
+            w = numpy.zeros(len(self.layers))
+            for name, weight in weights.items():
+                w[self._index[name]] = weight
+        else:
+            w = numpy.asarray(weights, dtype=float)
+        self._weights[id(influence)] = w
+        super(LayeredInfluenceMap, self).place(influence, update)
+
+    def remove(self, influence):
+        super(LayeredInfluenceMap, self).remove(influence)
+        self._weights.pop(id(influence), None)
+
+    def get_value(self, x, y):
+        """Return the values of all the layers at a position, or zeros
+        outside the map."""
+        if 0 < x < self.width and 0 < y < self.height:
+            return super(LayeredInfluenceMap, self).get_value(x, y)
+        else:
+            return numpy.zeros(len(self.layers))
+
+    def layer(self, name):
+        """Return a view of a layer of the map, that shares its values."""
+        view = self._views.get(name)
+        if view is None:
+            view = self._views[name] = MapLayer(self, self._index[name])
+        return view
+
+    def _compute(self, influence):
+        box, values = super(LayeredInfluenceMap, self)._compute(influence)
+        if values is not None:
+            values = (numpy.asarray(values)[..., None] *
+                      self._weights[id(influence)])
+        return box, values
+
+    def _mark_changed(self, y0, y1):
+        super(LayeredInfluenceMap, self)._mark_changed(y0, y1)
+        for view in self._views.values():
+            view._mark_changed(y0, y1)
+
+
+class MapLayer(GridMap):
+    """A view of a single layer of a :class:`LayeredInfluenceMap`. It shares
+    the values of the map, and has its own dirty flag so that each layer can
+    be displayed separately."""
+
+    def __init__(self, imap, index):
+        self.width = imap.width
+        self.height = imap.height
+        self.map_width = imap.map_width
+        self.map_height = imap.map_height
+        self.sector = imap.sector
+        self.maximum = imap.maximum
+        self.dirty = True
+        self.changed_lines = (0, self.map_height)
+
+        self._imap = imap._imap[:, :, index]
+
+
+class DiffusionField(GridMap):
+    """A map of a quantity that is deposited in the world (e.g. pheromones or
+    heat), and that diffuses to the neighbouring sectors and decays over
+    time. Values are limited to the maximum.
+
+    On each :meth:`step`, each sector keeps part of its value and receives
+    the rest from the mean of its 3x3 neighbourhood, computed for the whole
+    map at once with NumPy.
+
+    :param diffusion: The fraction of the value of a sector that is spread
+                      to its neighbours, per second.
+    :param decay: The rate of exponential decay of the values, per second.
+    :param limit: Values below this limit are set to 0.
+    :param tor: If True, the field wraps around the edges of the world.
+                Otherwise, the values beyond the edges are taken as equal to
+                the sectors on the edge.
+    """
+
+    def __init__(self, width, height, sector, diffusion = 0.5, decay = 0.1,
+                 maximum = 1.0, limit = 0.001, tor = False):
+        super(DiffusionField, self).__init__(width, height, sector, maximum)
+        self.diffusion = diffusion
+        self.decay = decay
+        self.limit = limit
+        self.tor = tor
+
+    def deposit(self, x, y, amount):
+        """Add an amount to the sector at the (x, y) position of the world.
+        Positions outside the map are ignored."""
+        if 0 <= x < self.map_width * self.sector and \
+                0 <= y < self.map_height * self.sector:
+            c = int(x // self.sector)
+            l = int(y // self.sector)
+            self._imap[l, c] = min(self._imap[l, c] + amount, self.maximum)
+            self._mark_changed(l, l + 1)
+
+    def deposit_many(self, xs, ys, amounts):
+        """Add amounts to the sectors at many positions at once (e.g. for all
+        the agents of a world). Positions outside the map are ignored."""
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        amounts = numpy.broadcast_to(numpy.asarray(amounts, dtype=float),
+                                     xs.shape)
+        c = numpy.floor(xs / self.sector).astype(numpy.intp)
+        l = numpy.floor(ys / self.sector).astype(numpy.intp)
+        inside = ((c >= 0) & (c < self.map_width) &
+                  (l >= 0) & (l < self.map_height))
+        if inside.any():
+            numpy.add.at(self._imap, (l[inside], c[inside]), amounts[inside])
+            numpy.minimum(self._imap, self.maximum, out=self._imap)
+            self._mark_changed(l[inside].min(), l[inside].max() + 1)
+
+    def step(self, delta):
+        """Diffuse and decay the field by a time step of delta seconds."""
+        values = self._imap
+        padded = numpy.pad(values, 1, mode='wrap' if self.tor else 'edge')
+        h, w = values.shape
+        mean = sum(padded[i:i + h, j:j + w]
+                   for i in range(3) for j in range(3)) / 9
+
+        d = min(self.diffusion * delta, 1.0)
+        values *= 1 - d
+        values += d * mean
+        values *= math.exp(-self.decay * delta)
+        values[values < self.limit] = 0
+        numpy.minimum(values, self.maximum, out=values)
+
+        self._mark_changed(0, self.map_height)
+
+    def clear(self):
+        self._imap[:] = 0
+        self._mark_changed(0, self.map_height)
+
+
 class InfluenceMapDisplay(object):
-    """This class is used to display the influence map on a 2D world"""
+    """This class is used to display the influence map on a 2D world.
+
+    All the sectors are drawn from a single vertex list. When the map
+    changes, the colors of the changed lines are computed with NumPy and
+    copied to the vertex buffer at once.
+    """
 
     def __init__(self, imap, color = ('c3B', (255,0,0))):
-        self.batch = pyglet.graphics.Batch()
+        self.batch = None
         self.imap = imap
         self.color = color
-        self.vlists = []
-        shape = shapes.Rect(imap.sector, imap.sector,
-                            imap.sector/2, imap.sector/2, color)
-        n = len(shape.vertices[1]) // 2
-        t = imap.sector
+        self.vlist = None
 
-        #create shape objects
-        for y in range(imap.map_height):
-            self.vlists.append([])
-            for x in range(imap.map_width):
-                #get influence value
-                v = imap.get_grid_value(x, y)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['batch'] = None
+        state['vlist'] = None
+        return state
 
-                #normalize
-                v = v / imap.maximum
+    def _create_batch(self):
+        # Only called on the first draw, so that no OpenGL resources are used
+        # when the simulation runs without a display
+        self.batch = pyglet.graphics.Batch()
+        imap = self.imap
+        s = imap.sector
+
+        # the 4 corners of each sector, line by line
+        x0 = numpy.arange(imap.map_width) * s
+        y0 = numpy.arange(imap.map_height) * s
+        vertices = numpy.empty((imap.map_height, imap.map_width, 4, 2),
+                               dtype=numpy.float32)
+        vertices[..., 0] = x0[None, :, None] + numpy.array([0, s, s, 0])
+        vertices[..., 1] = y0[:, None, None] + numpy.array([0, 0, s, s])
+
+        n = imap.map_width * imap.map_height * 4
+        colors = self._get_colors(0, imap.map_height)
+        self.vlist = self.batch.add(n, pyglet.gl.GL_QUADS, None,
+                                    ('v2f/static', vertices.ravel().tolist()),
+                                    (self.color[0] + '/dynamic',
+                                     colors.tolist()))
 
-                #change color
-                new_color = (self.color[0], [int(c*v) for c in self.color[1]])
+        imap.dirty = False
+        imap.changed_lines = None
+
+    def _get_sector_colors(self, y0, y1):
+        """Return the colors of the sectors in lines y0 to y1, as a NumPy
+        array indexed by [line, column, component]."""
+        v = self.imap._imap[y0:y1] / self.imap.maximum
+        colors = v[:, :, None] * numpy.asarray(self.color[1], dtype=float)
+        if self.color[0].endswith('B'):
+            return colors.astype(numpy.uint8)
+        return colors.astype(numpy.float32)
+
+    def _get_colors(self, y0, y1):
+        """Return the vertex colors of the sectors in lines y0 to y1 as a
+        flat NumPy array."""
+        # the same color for the 4 vertices of each sector
+        return numpy.repeat(self._get_sector_colors(y0, y1), 4,
+                            axis=1).ravel()
 
-                #create shape in batch and save to list
-                new_vertices = shape.translate(x*imap.sector, y*imap.sector)
-                vlist = self.batch.add(n, shape.gl_type, None,
-                                       ('v2f', new_vertices),
-                                       (new_color[0], new_color[1]*n))
-                self.vlists[y].append(vlist)
+    def update(self):
+        if self.batch is not None and self.imap.dirty:
+            if self.imap.changed_lines is not None:
+                y0, y1 = self.imap.changed_lines
+                colors = self._get_colors(y0, y1)
+
+                # upload only the region of the changed lines
+                attribute = self.vlist.domain.attribute_names['colors']
+                per_line = self.imap.map_width * 4
+                region = attribute.get_region(
+                    attribute.buffer, self.vlist.start + y0 * per_line,
+                    (y1 - y0) * per_line)
+                ctypes.memmove(region.array, colors.ctypes.data,
+                               colors.nbytes)
+                region.invalidate()
 
+            self.imap.dirty = False
+            self.imap.changed_lines = None
 
+    def draw(self):
+        if self.batch is None:
+            self._create_batch()
+        self.batch.draw()
 
-        imap.dirty = False
 
-    def update(self):
-        if (self.imap.dirty):
-            for y in range(self.imap.map_height):
-                for x in range(self.imap.map_width):
-                    #get influence value
-                    v = self.imap.get_grid_value(x, y)
+class InfluenceMapTextureDisplay(InfluenceMapDisplay):
+    """Displays the influence map as a single texture, with one pixel per
+    sector, stretched over the world. It uses less memory than
+    :class:`InfluenceMapDisplay` and is drawn with a single call, so it is
+    better suited to maps with small sectors.
+
+    When the map changes, only the changed lines of the texture are
+    uploaded. The color must be given in unsigned bytes (e.g. 'c3B' or
+    'c4B').
+    """
 
-                    #normalize
-                    v = v / self.imap.maximum
+    def __init__(self, imap, color = ('c3B', (255,0,0))):
+        super(InfluenceMapTextureDisplay, self).__init__(imap, color)
+        self.texture = None
+        self._format = 'RGBA' if len(color[1]) == 4 else 'RGB'
+
+    def __getstate__(self):
+        state = super(InfluenceMapTextureDisplay, self).__getstate__()
+        state['texture'] = None
+        return state
+
+    def _create_texture(self):
+        imap = self.imap
+        self.texture = pyglet.image.Texture.create(
+            imap.map_width, imap.map_height,
+            min_filter=pyglet.gl.GL_NEAREST, mag_filter=pyglet.gl.GL_NEAREST)
+        self._upload(0, imap.map_height)
+
+        imap.dirty = False
+        imap.changed_lines = None
 
-                    #set color
-                    vertexlist = self.vlists[y][x]
-                    vertexlist.colors[:] = [int(c*v) for c in self.color[1]] * 4
+    def _upload(self, y0, y1):
+        """Copy the lines y0 to y1 of the map to the texture."""
+        # the first line of the map is the bottom line of the image
+        colors = self._get_sector_colors(y0, y1)
+        image = pyglet.image.ImageData(self.imap.map_width, y1 - y0,
+                                       self._format, colors.tobytes())
+        self.texture.blit_into(image, 0, y0, 0)
+
+    def update(self):
+        if self.texture is not None and self.imap.dirty:
+            if self.imap.changed_lines is not None:
+                self._upload(*self.imap.changed_lines)
 
             self.imap.dirty = False
+            self.imap.changed_lines = None
 
     def draw(self):
-        self.batch.draw()
\ No newline at end of file
+        if self.texture is None:
+            self._create_texture()
+        self.texture.blit(0, 0, width=self.imap.width,
+                          height=self.imap.height)
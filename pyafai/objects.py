@@ -25,13 +25,26 @@ __author__ = 'Tiago Baptista'
 
 from pyafai import Object
 import math
+import numpy
 
 DEG2RAD = math.pi / 180
 
 class SimplePhysicsObject(Object):
-    """A simple physics object that can move in 2D space."""
+    """A simple physics object that can move in 2D space.
+
+    The object can be attached to a :class:`PhysicsStore`, that integrates
+    the movement of all its objects at once. While attached, the position,
+    angle and velocities of the object are kept in the store, and its class
+    is switched to a subclass that reads them from there, so objects that
+    are not in a store keep using plain attributes.
+    """
+
+    __slots__ = ('_store', '_slot', '_vel', '_velx', '_vely', '_ang_vel')
 
     def __init__(self, x=0, y=0, angle=0):
+        self._store = None
+        self._slot = None
+
         super(SimplePhysicsObject, self).__init__(x, y, angle)
 
         self._vel = 0.0
@@ -74,3 +87,222 @@ class SimplePhysicsObject(Object):
         self._angle = value
         self.velocity = self._vel
 
+
+class _StoredPhysicsObject(SimplePhysicsObject):
+    """The class of the SimplePhysicsObjects attached to a PhysicsStore,
+    whose position, angle and velocities are kept in the store."""
+
+    __slots__ = ()
+
+    def __reduce_ex__(self, protocol):
+        # the stored classes of subclasses are created at run time, so they
+        # are pickled by the class of the object outside the store
+        return (_new_stored, (_unstored_class(type(self)),),
+                self.__getstate__())
+
+    @property
+    def x(self):
+        return self._store.x[self._slot]
+
+    @x.setter
+    def x(self, value):
+        self._store.x[self._slot] = value
+
+    @property
+    def y(self):
+        return self._store.y[self._slot]
+
+    @y.setter
+    def y(self, value):
+        self._store.y[self._slot] = value
+
+    @property
+    def velocity(self):
+        return self._store.vel[self._slot]
+
+    @velocity.setter
+    def velocity(self, v):
+        self._store.vel[self._slot] = v
+
+    @property
+    def ang_velocity(self):
+        return self._store.ang_vel[self._slot]
+
+    @ang_velocity.setter
+    def ang_velocity(self, v):
+        self._store.ang_vel[self._slot] = v
+
+    def update(self, delta):
+        # integrated by the store
+        pass
+
+    @property
+    def angle(self):
+        return self._store.angle[self._slot]
+
+    @angle.setter
+    def angle(self, value):
+        #normalize
+        while value > 360:
+            value -= 360
+        while value < 0:
+            value += 360
+
+        self._store.angle[self._slot] = value
+
+
+# class -> its stored subclass, and the reverse
+_stored_classes = {SimplePhysicsObject: _StoredPhysicsObject}
+_unstored_classes = {_StoredPhysicsObject: SimplePhysicsObject}
+
+
+def _stored_class(cls):
+    """Return the class to use for objects of a SimplePhysicsObject subclass
+    while they are in a PhysicsStore. It adds no attributes, so objects can
+    switch between both classes."""
+    stored = _stored_classes.get(cls)
+    if stored is None:
+        stored = type(cls.__name__, (cls, _StoredPhysicsObject),
+                      {'__slots__': (), '__module__': cls.__module__})
+        _stored_classes[cls] = stored
+        _unstored_classes[stored] = cls
+    return stored
+
+
+def _unstored_class(cls):
+    return _unstored_classes[cls]
+
+
+def _new_stored(cls):
+    """Create an empty object of the stored class of cls (used to unpickle
+    objects in a PhysicsStore)."""
+    return object.__new__(_stored_class(cls))
+
+
+class PhysicsStore(object):
+    """Keeps the position, angle and velocities of SimplePhysicsObjects in
+    contiguous NumPy arrays, and integrates the movement of all of them in a
+    single vectorized step.
+
+    Only objects that do not override :meth:`SimplePhysicsObject.update` can
+    be added, as their update is replaced by :meth:`step`.
+    """
+
+    def __init__(self, capacity=64):
+        self._objects = []
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.angle = numpy.zeros(capacity)
+        self.vel = numpy.zeros(capacity)
+        self.ang_vel = numpy.zeros(capacity)
+        # cell coordinates, as last returned by changed_cells
+        self._cx = numpy.zeros(capacity)
+        self._cy = numpy.zeros(capacity)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, obj):
+        return getattr(obj, '_store', None) is self
+
+    @staticmethod
+    def accepts(obj):
+        return (isinstance(obj, SimplePhysicsObject) and
+                type(obj).update is SimplePhysicsObject.update)
+
+    def _grow(self):
+        for name in ('x', 'y', 'angle', 'vel', 'ang_vel', '_cx', '_cy'):
+            array = getattr(self, name)
+            new = numpy.zeros(2 * len(array))
+            new[:len(array)] = array
+            setattr(self, name, new)
+
+    def add(self, obj):
+        if not self.accepts(obj):
+            print("Trying to add an object to the physics store that is not \
+            a SimplePhysicsObject, or overrides its update method!")
+            return
+
+        slot = len(self._objects)
+        if slot == len(self.x):
+            self._grow()
+
+        self.x[slot] = obj.x
+        self.y[slot] = obj.y
+        self.angle[slot] = obj.angle
+        self.vel[slot] = obj.velocity
+        self.ang_vel[slot] = obj.ang_velocity
+        self._cx[slot] = numpy.nan
+        self._cy[slot] = numpy.nan
+        self._objects.append(obj)
+        obj._store = self
+        obj._slot = slot
+        obj.__class__ = _stored_class(type(obj))
+
+    def remove(self, obj):
+        if obj not in self:
+            print("Trying to remove an object that is not in the physics \
+            store!")
+            return
+
+        slot = obj._slot
+        x, y = self.x[slot], self.y[slot]
+        angle, vel = self.angle[slot], self.vel[slot]
+        ang_vel = self.ang_vel[slot]
+
+        # move the last object to the free slot
+        last = self._objects.pop()
+        if last is not obj:
+            self._objects[slot] = last
+            for array in (self.x, self.y, self.angle, self.vel, self.ang_vel,
+                          self._cx, self._cy):
+                array[slot] = array[len(self._objects)]
+            last._slot = slot
+
+        # the object keeps its own state again
+        obj.__class__ = _unstored_class(type(obj))
+        obj._store = None
+        obj._slot = None
+        obj.x = float(x)
+        obj.y = float(y)
+        obj._angle = float(angle)
+        obj.ang_velocity = float(ang_vel)
+        obj.velocity = float(vel)
+
+    def step(self, delta, width=None, height=None):
+        """Integrate the movement of all the objects.
+
+        :param delta: The time step, in seconds.
+        :param width: If given, keep the objects in [0, width] on x.
+        :param height: If given, keep the objects in [0, height] on y.
+        """
+        n = len(self._objects)
+        x = self.x[:n]
+        y = self.y[:n]
+        angle = self.angle[:n]
+
+        angle += self.ang_vel[:n] * delta
+        numpy.mod(angle, 360, out=angle)
+
+        rad = angle * DEG2RAD
+        dist = self.vel[:n] * delta
+        x += dist * numpy.cos(rad)
+        y += dist * numpy.sin(rad)
+
+        if width is not None:
+            numpy.clip(x, 0, width, out=x)
+        if height is not None:
+            numpy.clip(y, 0, height, out=y)
+
+    def changed_cells(self, cell):
+        """Return a list of the objects that changed to another cell of size
+        cell since the last call (e.g. to update a spatial index)."""
+        n = len(self._objects)
+        cx = numpy.floor(self.x[:n] / cell)
+        cy = numpy.floor(self.y[:n] / cell)
+        changed = numpy.flatnonzero((cx != self._cx[:n]) |
+                                    (cy != self._cy[:n]))
+        self._cx[:n] = cx
+        self._cy[:n] = cy
+
+        return [self._objects[i] for i in changed]
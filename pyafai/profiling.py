@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014-2016 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""This module contains a simple profiler that measures the time spent in
+each phase of the update of a world."""
+
+from __future__ import division
+from collections import deque, OrderedDict
+import timeit
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+
+class _Measure(object):
+    """Context manager returned by :meth:`Profiler.measure`."""
+
+    def __init__(self, profiler, phase):
+        self.profiler = profiler
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, *args):
+        self.profiler.split(self.phase, timeit.default_timer() - self.start)
+
+
+class Profiler(object):
+    """Keeps the time spent in each phase of the last ticks of a world.
+
+    The world measures its own phases when it has a profiler (see
+    :meth:`pyafai.World.start_profiling`). The world does not own influence
+    maps, so their updates, and other phases, are measured with
+    :meth:`measure`::
+
+        with world.profiler.measure('influences'):
+            imap.update_influences(delta)
+
+    A phase measured inside another (with :meth:`measure` or :meth:`split`)
+    is left out of the enclosing phase, so the phases do not overlap.
+
+    The times recorded for the same phase during a tick are added, and the
+    statistics are computed over the last window ticks. Times that do not
+    belong to a tick (e.g. the display's 'draw' phase, measured once per
+    frame) are kept with :meth:`record_frame`, each as its own sample.
+
+    :param window: The number of ticks to keep.
+    :param agent_classes: If True, also measure the time spent updating the
+                          agents of each class, in phases named 'agent:' and
+                          the name of the class.
+    """
+
+    def __init__(self, window=120, agent_classes=False):
+        self.window = window
+        self.agent_classes = agent_classes
+        self.ticks = 0
+        self._current = OrderedDict()
+        self._samples = OrderedDict()
+        self._lap = None
+
+    def record(self, phase, seconds):
+        """Add a time, in seconds, to a phase of the current tick."""
+        self._current[phase] = self._current.get(phase, 0.0) + seconds
+
+    def split(self, phase, seconds):
+        """Add a time, in seconds, to a phase measured inside the current
+        lap, and leave it out of that lap."""
+        self.record(phase, seconds)
+        if self._lap is not None:
+            self._lap += seconds
+
+    def record_frame(self, phase, seconds):
+        """Add a time, in seconds, to a phase measured outside the ticks, as a
+        sample of its own."""
+        self._add_sample(phase, seconds)
+
+    def measure(self, phase):
+        """Return a context manager that records the time spent in its block
+        in a phase."""
+        return _Measure(self, phase)
+
+    def start(self):
+        """Start measuring a sequence of phases with :meth:`lap`."""
+        self._lap = timeit.default_timer()
+
+    def lap(self, phase):
+        """Record the time since the last call to :meth:`start` or
+        :meth:`lap` in a phase."""
+        now = timeit.default_timer()
+        self.record(phase, now - self._lap)
+        self._lap = now
+
+    def end_tick(self):
+        """Close the current tick, adding its times to the statistics."""
+        for phase, seconds in self._current.items():
+            self._add_sample(phase, seconds)
+        self._current = OrderedDict()
+        self.ticks += 1
+
+    def _add_sample(self, phase, seconds):
+        samples = self._samples.get(phase)
+        if samples is None:
+            samples = self._samples[phase] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def reset(self):
+        self.ticks = 0
+        self._current.clear()
+        self._samples.clear()
+
+    def stats(self):
+        """Return an ordered dictionary with the statistics of each phase,
+        in seconds: a dictionary with the mean, max and last times."""
+        result = OrderedDict()
+        for phase, samples in self._samples.items():
+            result[phase] = {'mean': sum(samples) / len(samples),
+                             'max': max(samples),
+                             'last': samples[-1]}
+        return result
+
+    def report(self):
+        """Return a table with the statistics of each phase, in
+        milliseconds."""
+        stats = self.stats()
+        width = max([len(phase) for phase in stats] + [5])
+        lines = ['%-*s %9s %9s %9s' % (width, 'phase', 'mean ms', 'max ms',
+                                       'last ms')]
+        for phase, s in stats.items():
+            lines.append('%-*s %9.3f %9.3f %9.3f' % (width, phase,
+                                                     s['mean'] * 1000,
+                                                     s['max'] * 1000,
+                                                     s['last'] * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014-2016 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""This module contains renderers that draw all the objects of a world at
+once, instead of drawing each object with its own batch."""
+
+from __future__ import division
+import ctypes
+import math
+import numpy
+import pyglet
+from . import shapes
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+DEG2RAD = math.pi / 180
+
+# OpenGL modes where the vertices of many shapes can be put in a single list
+_SHAREABLE_MODES = (pyglet.gl.GL_POINTS, pyglet.gl.GL_LINES,
+                    pyglet.gl.GL_TRIANGLES, pyglet.gl.GL_QUADS)
+
+
+class _ShapeGroup(object):
+    """The vertices of all the shapes with the same OpenGL mode and color
+    format."""
+
+    def __init__(self, mode, color_format):
+        self.mode = mode
+        self.color_format = color_format
+        self.local = []
+        self.owners = []
+        self.colors = []
+        self.vertexlist = None
+
+    def add(self, owner, vertices, color):
+        self.local.append(vertices)
+        self.owners.append(numpy.full(len(vertices), owner, dtype=numpy.intp))
+        self.colors.extend(list(color) * len(vertices))
+
+    def finish(self):
+        self.local = numpy.concatenate(self.local)
+        self.owners = numpy.concatenate(self.owners)
+
+    def compute_vertices(self, x, y, cos, sin):
+        """Return the vertices of all the shapes, in world coordinates, as a
+        flat float32 array. The arguments are the position, and the cosine
+        and sine of the angle (multiplied by the scale) of each object."""
+        lx = self.local[:, 0]
+        ly = self.local[:, 1]
+        c = cos[self.owners]
+        s = sin[self.owners]
+        result = numpy.empty((len(lx), 2), dtype=numpy.float32)
+        result[:, 0] = x[self.owners] + c * lx - s * ly
+        result[:, 1] = y[self.owners] + s * lx + c * ly
+        return result.ravel()
+
+
+class ObjectRenderer(object):
+    """Draws all the objects of a world from a few shared vertex lists (one
+    for each OpenGL mode and color format), with the transformation of each
+    object applied to its vertices with NumPy.
+
+    Sprites are drawn from the same batch, and share the textures of their
+    images. Objects that have shapes that can not be merged (e.g. shapes
+    using OpenGL strips or fans) are drawn one by one, as usual.
+
+    The positions of the objects are converted to the screen using the
+    world's pixel transform (e.g. from cells to pixels in a grid world),
+    without changing the objects.
+
+    The shapes are collected again when objects are added or removed, or
+    when the number of shapes of an object changes. Changes to the color or
+    vertices of a shape are only seen after calling :meth:`invalidate`.
+
+    To use it, set the renderer attribute of the world::
+
+        world.renderer = render.ObjectRenderer(world)
+
+    :param world: The world to draw.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self._batch = None
+        self._groups = []
+        self._objects = []
+        self._others = []
+        # (object index, shape, pyglet sprite)
+        self._sprites = []
+        self._signature = None
+
+    def invalidate(self):
+        """Collect the shapes of all objects again on the next draw."""
+        self._signature = None
+
+    @staticmethod
+    def _get_vertices(shape):
+        """Return the vertices of a shape as an (n, 2) array, or None if the
+        shape can not be merged with others."""
+        if getattr(shape, 'gl_type', None) not in _SHAREABLE_MODES or \
+                shape.vertices is None or shape.vertices[0][:2] != 'v2':
+            return None
+        vertices = numpy.asarray(shape.vertices[1],
+                                 dtype=numpy.float64).reshape(-1, 2)
+        if shape.indices is not None:
+            vertices = vertices[shape.indices]
+        return vertices
+
+    def _collect(self):
+        """Group the shapes of all the objects."""
+        groups = {}
+        self._objects = []
+        self._others = []
+        self._sprites = []
+        for obj in self.world._objects:
+            entries = [(shape, self._get_vertices(shape))
+                       for shape in obj._shapes]
+            if any(vertices is None and not isinstance(shape, shapes.Sprite)
+                   for shape, vertices in entries):
+                self._others.append(obj)
+                continue
+
+            owner = len(self._objects)
+            self._objects.append(obj)
+            for shape, vertices in entries:
+                if vertices is None:
+                    self._sprites.append((owner, shape, None))
+                    continue
+                key = (shape.gl_type, shape.color[0])
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = _ShapeGroup(*key)
+                group.add(owner, vertices, shape.color[1])
+
+        self._groups = list(groups.values())
+        for group in self._groups:
+            group.finish()
+
+    def _rebuild(self):
+        for group in self._groups:
+            if group.vertexlist is not None:
+                group.vertexlist.delete()
+        for owner, shape, sprite in self._sprites:
+            if sprite is not None:
+                sprite.delete()
+        self._collect()
+
+        if self._batch is None:
+            self._batch = pyglet.graphics.Batch()
+        for group in self._groups:
+            n = len(group.local)
+            group.vertexlist = self._batch.add(
+                n, group.mode, None, ('v2f/stream', [0.0] * (2 * n)),
+                (group.color_format + '/static', group.colors))
+        self._sprites = [(owner, shape,
+                          pyglet.sprite.Sprite(
+                              shapes.get_texture(shape.filename),
+                              batch=self._batch))
+                         for owner, shape, sprite in self._sprites]
+
+    def _get_transforms(self):
+        """Return the position, and the cosine and sine of the angle scaled
+        by the scale, of each object as NumPy arrays."""
+        state = numpy.array([(obj.x, obj.y, obj.angle, obj.scale)
+                             for obj in self._objects],
+                            dtype=numpy.float64).reshape(-1, 4)
+        scale, offset = self.world.get_pixel_transform()
+        rad = state[:, 2] * DEG2RAD
+        return (state[:, 0] * scale + offset, state[:, 1] * scale + offset,
+                numpy.cos(rad) * state[:, 3], numpy.sin(rad) * state[:, 3])
+
+    def draw(self):
+        signature = [(id(obj), len(obj._shapes))
+                     for obj in self.world._objects]
+        if signature != self._signature:
+            self._rebuild()
+            self._signature = signature
+
+        if self._objects:
+            x, y, cos, sin = self._get_transforms()
+            for group in self._groups:
+                vertices = group.compute_vertices(x, y, cos, sin)
+                ctypes.memmove(group.vertexlist.vertices,
+                               vertices.ctypes.data, vertices.nbytes)
+            for owner, shape, sprite in self._sprites:
+                obj = self._objects[owner]
+                c = cos[owner]
+                s = sin[owner]
+                # pyglet rotates sprites clockwise
+                sprite.update(x[owner] + c * shape._cx - s * shape._cy,
+                              y[owner] + s * shape._cx + c * shape._cy,
+                              -obj.angle, obj.scale)
+            self._batch.draw()
+
+        if self._others:
+            scale, offset = self.world.get_pixel_transform()
+            for obj in self._others:
+                obj.draw_at(obj.x * scale + offset, obj.y * scale + offset)
@@ -20,13 +20,73 @@ This module contains helper classes to draw basic shapes in pyglet.
 """
 
 from __future__ import division
+from collections import OrderedDict
 import pyglet
-import math
+import numpy
 from math import pi
 
 __docformat__ = 'restructuredtext'
 __author__ = 'Tiago Baptista'
 
+# the maximum number of geometries kept in the cache
+GEOMETRY_CACHE_SIZE = 256
+
+# (shape class, parameters) -> array of vertices, most recently used last
+_geometry_cache = OrderedDict()
+
+
+def _get_geometry(key, compute):
+    """Return the vertices of a procedural shape from the cache, calling
+    compute to create them if they are not there. The vertices are shared by
+    all the shapes with the same key, so they are kept in a read only float32
+    array."""
+    vertices = _geometry_cache.pop(key, None)
+    if vertices is None:
+        vertices = numpy.array(compute(), dtype=numpy.float32)
+        vertices.flags.writeable = False
+        if len(_geometry_cache) >= GEOMETRY_CACHE_SIZE:
+            _geometry_cache.popitem(last=False)
+    _geometry_cache[key] = vertices
+    return vertices
+
+
+# filename -> image, and filename -> texture region, shared by all sprites
+_images = {}
+_textures = {}
+_texture_bin = None
+
+
+def load_image(filename):
+    """Return the image in a file. Each file is only loaded once."""
+    image = _images.get(filename)
+    if image is None:
+        image = _images[filename] = pyglet.image.load(filename)
+    return image
+
+
+def get_texture(filename):
+    """Return the texture of the image in a file, anchored at its center.
+
+    The images are packed in shared atlas textures, so that sprites of the
+    same or different files can be drawn together. Needs an OpenGL context.
+    """
+    global _texture_bin
+    texture = _textures.get(filename)
+    if texture is None:
+        from pyglet.image import atlas
+        if _texture_bin is None:
+            _texture_bin = atlas.TextureBin()
+        image = load_image(filename)
+        try:
+            texture = _texture_bin.add(image)
+        except atlas.AllocatorException:
+            # the image is larger than an atlas
+            texture = image.get_texture()
+        texture.anchor_x = image.width // 2
+        texture.anchor_y = image.height // 2
+        _textures[filename] = texture
+    return texture
+
 
 class Shape(object):
     def __init__(self, color=('c3B', (255,255,255))):
@@ -40,6 +100,13 @@ class Shape(object):
         if self.vertexlist != None:
             self.vertexlist.delete()
 
+    def __getstate__(self):
+        # vertex lists hold OpenGL resources, they are created again when the
+        # shape is added to a batch
+        state = self.__dict__.copy()
+        state['vertexlist'] = None
+        return state
+
     @property
     def color(self):
         return self._color
@@ -69,10 +136,8 @@ class Shape(object):
                     reuse.")
 
     def translate(self, tx, ty):
-        res = [(v[0] + tx, v[1] + ty) for v in zip(self.vertices[1][::2],
-                                                   self.vertices[1][1::2])]
-        res = [x for v in res for x in v]
-        return res
+        res = numpy.asarray(self.vertices[1], dtype=float).reshape(-1, 2)
+        return (res + (tx, ty)).ravel().tolist()
 
 
 class Rect(Shape):
@@ -107,26 +172,33 @@ class Triangle(Shape):
         
 
 class Circle(Shape):
+    """A circle made of triangles. The vertices are cached, so circles with
+    the same radius and resolution share them (circles with a center other
+    than the origin get a translated copy)."""
+
     def __init__(self, r, cx=0, cy=0, color=('c3B', (255, 255, 255)),
                  res=1):
         Shape.__init__(self, color)
         
         self.gl_type = pyglet.gl.GL_TRIANGLES
+        vertices = _get_geometry((Circle, r, res),
+                                 lambda: self._compute_vertices(r, res))
+        if cx != 0 or cy != 0:
+            center = numpy.array((cx, cy), dtype=numpy.float32)
+            vertices = (vertices.reshape(-1, 2) + center).ravel()
+        self.vertices = ('v2f', vertices)
+
+    @staticmethod
+    def _compute_vertices(r, res):
         sides = int(pi*r*res)
-        dang = 2*pi / sides
-        ang = 0
-        x = math.cos(ang) * r
-        y = math.sin(ang) * r
-        vertices = [0, 0, r, 0, x, y]
-        for i in range(sides+1):
-            x = math.cos(ang) * r
-            y = math.sin(ang) * r
-            vertices.extend([0, 0, vertices[-2], vertices[-1], x, y])
-            ang += dang
+        ang = numpy.arange(sides + 1) * (2*pi / sides)
+        points = numpy.column_stack((numpy.cos(ang) * r, numpy.sin(ang) * r))
 
-        self.vertices = ('v2f', vertices)
-        vertices = self.translate(cx, cy)
-        self.vertices = ('v2f', vertices)
+        # a fan of triangles from the center, starting with a degenerate one
+        triangles = numpy.zeros((sides + 2, 3, 2))
+        triangles[:, 1] = numpy.vstack((points[:1], points[:1], points[:-1]))
+        triangles[:, 2] = numpy.vstack((points[:1], points))
+        return triangles.ravel()
 
 
 class Pointer(Shape):
@@ -163,13 +235,32 @@ class Grid(Shape):
 
 
 class Sprite(Shape):
+    """A shape with the image of a file, centered at (cx, cy). All the sprites
+    share the images and textures of the same files (see
+    :func:`get_texture`)."""
+
     def __init__(self, filename, cx=0, cy=0):
         Shape.__init__(self)
-        image = pyglet.image.load(filename)
-        image.anchor_x = image.width // 2
-        image.anchor_y = image.height // 2
-        self._sprite = pyglet.sprite.Sprite(image, cx, cy)
+        # load the image now, to report missing files when the shape is
+        # created
+        load_image(filename)
+        self.filename = filename
+        self._cx = cx
+        self._cy = cy
+        # the sprite needs an OpenGL texture, so it is only created when the
+        # shape is added to a batch
+        self._sprite = None
+
+    def __getstate__(self):
+        state = Shape.__getstate__(self)
+        state['_sprite'] = None
+        return state
 
     def add_to_batch(self, batch):
-        self._sprite.batch = batch
+        if self._sprite is None:
+            self._sprite = pyglet.sprite.Sprite(get_texture(self.filename),
+                                                self._cx, self._cy,
+                                                batch=batch)
+        else:
+            self._sprite.batch = batch
 
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014-2016 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""This module contains spatial indexes, used to speed up queries on the
+position of the objects in a world."""
+
+from __future__ import division
+import math
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+
+class SpatialHash(object):
+    """A uniform grid of buckets indexing objects by their (x, y) position.
+
+    Buckets are only created for cells that contain objects, so the world
+    does not need to be bounded. The index is not aware of the objects'
+    movement, :meth:`update` must be called after an object moves.
+
+    :param cell: The size of the side of each cell.
+    """
+
+    def __init__(self, cell):
+        self.cell = cell
+        # (column, line) -> {id(obj): obj}
+        self._buckets = {}
+        # id(obj) -> (column, line)
+        self._keys = {}
+
+    def __getstate__(self):
+        # the objects are indexed by their id, which changes when copied
+        return {'cell': self.cell,
+                'buckets': [(key, list(bucket.values()))
+                            for key, bucket in self._buckets.items()]}
+
+    def __setstate__(self, state):
+        self.__init__(state['cell'])
+        for key, objects in state['buckets']:
+            self._buckets[key] = dict((id(obj), obj) for obj in objects)
+            for obj in objects:
+                self._keys[id(obj)] = key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, obj):
+        return id(obj) in self._keys
+
+    def _get_key(self, x, y):
+        return int(math.floor(x / self.cell)), int(math.floor(y / self.cell))
+
+    def add(self, obj):
+        key = self._get_key(obj.x, obj.y)
+        self._keys[id(obj)] = key
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = {}
+        bucket[id(obj)] = obj
+
+    def remove(self, obj):
+        key = self._keys.pop(id(obj), None)
+        if key is not None:
+            bucket = self._buckets[key]
+            del bucket[id(obj)]
+            if not bucket:
+                del self._buckets[key]
+
+    def update(self, obj):
+        """Move an object to the bucket of its current position, if it changed
+        cell since it was last indexed."""
+        key = self._get_key(obj.x, obj.y)
+        old = self._keys[id(obj)]
+        if key != old:
+            bucket = self._buckets[old]
+            del bucket[id(obj)]
+            if not bucket:
+                del self._buckets[old]
+            self._keys[id(obj)] = key
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = {}
+            bucket[id(obj)] = obj
+
+    def clear(self):
+        self._buckets.clear()
+        self._keys.clear()
+
+    def _iter_cells(self, x1, y1, x2, y2):
+        """Iterate over the buckets that intersect a rectangle."""
+        c1, l1 = self._get_key(x1, y1)
+        c2, l2 = self._get_key(x2, y2)
+        if (c2 - c1 + 1) * (l2 - l1 + 1) > len(self._buckets):
+            # it is faster to check all the occupied buckets
+            for (c, l), bucket in self._buckets.items():
+                if c1 <= c <= c2 and l1 <= l <= l2:
+                    yield bucket
+        else:
+            for l in range(l1, l2 + 1):
+                for c in range(c1, c2 + 1):
+                    bucket = self._buckets.get((c, l))
+                    if bucket is not None:
+                        yield bucket
+
+    def query_rect(self, x1, y1, x2, y2):
+        """Return a list of the objects inside a rectangle.
+
+        :param x1: The minimum x coordinate of the rectangle.
+        :param y1: The minimum y coordinate of the rectangle.
+        :param x2: The maximum x coordinate of the rectangle.
+        :param y2: The maximum y coordinate of the rectangle.
+        """
+        result = []
+        for bucket in self._iter_cells(x1, y1, x2, y2):
+            for obj in bucket.values():
+                if x1 <= obj.x <= x2 and y1 <= obj.y <= y2:
+                    result.append(obj)
+
+        return result
+
+    def query_radius(self, x, y, r):
+        """Return a list of the objects at a distance of at most r from the
+        point (x, y)."""
+        result = []
+        r2 = r * r
+        for bucket in self._iter_cells(x - r, y - r, x + r, y + r):
+            for obj in bucket.values():
+                if (obj.x - x) ** 2 + (obj.y - y) ** 2 <= r2:
+                    result.append(obj)
+
+        return result
+
+    def nearest(self, x, y, r=None, exclude=None):
+        """Return the object nearest to the point (x, y), or None if there
+        is none.
+
+        :param r: If given, only consider objects at a distance of at most r.
+        :param exclude: An object to ignore (e.g. the one doing the query).
+        """
+        if r is not None:
+            max_ring = int(math.ceil(r / self.cell))
+            best_d2 = r * r
+        else:
+            max_ring = None
+            best_d2 = float('inf')
+
+        c, l = self._get_key(x, y)
+        best = None
+        ring = 0
+        while max_ring is None or ring <= max_ring:
+            # all the objects in this ring are at least this far away
+            if best is not None and ((ring - 1) * self.cell) ** 2 > best_d2:
+                break
+            if (2 * ring + 1) ** 2 > len(self._buckets):
+                # it is faster to check all the occupied buckets at once
+                buckets = self._buckets.values()
+                last = True
+            else:
+                buckets = (self._buckets.get(key)
+                           for key in self._ring(c, l, ring))
+                last = False
+            for bucket in buckets:
+                if bucket is None:
+                    continue
+                for obj in bucket.values():
+                    if obj is exclude:
+                        continue
+                    d2 = (obj.x - x) ** 2 + (obj.y - y) ** 2
+                    if d2 < best_d2 or (best is None and d2 <= best_d2):
+                        best = obj
+                        best_d2 = d2
+            if last:
+                break
+            ring += 1
+
+        return best
+
+    @staticmethod
+    def _ring(c, l, ring):
+        """Iterate over the keys of the cells at a Chebyshev distance of ring
+        from the cell (c, l)."""
+        if ring == 0:
+            yield c, l
+            return
+        for i in range(c - ring, c + ring + 1):
+            yield i, l - ring
+            yield i, l + ring
+        for j in range(l - ring + 1, l + ring):
+            yield c - ring, j
+            yield c + ring, j
@@ -52,5 +52,5 @@ setup(
     ],
 
     packages=['pyafai'],
-    install_requires = ['pyglet'],
+    install_requires = ['pyglet', 'numpy'],
 )